@@ -0,0 +1,104 @@
+"""
+Benchmark the text, mmap and parallel cleaning paths of process_file_content.
+
+Each path runs in its own interpreter so peak RSS is measured in isolation.
+The parallel path is timed with a warm worker pool, as it is after the first
+upload; its peak RSS covers the parent process only.
+
+Usage: python benchmarks/bench_cleaning.py [--lines N] [--workers N]
+"""
+import argparse
+import filecmp
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def generate_input(path, lines, seed=1):
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(lines):
+            host = f"host{i}.example{rnd.randint(0, 99)}.com"
+            r = rnd.random()
+            if r < 0.3:
+                f.write(f"https://www.{host}/path/{i}?q=1\n")
+            elif r < 0.5:
+                f.write(f"  http://{host}  \n")
+            elif r < 0.55:
+                f.write("\n")
+            elif r < 0.6:
+                f.write(f"WWW.{host}/\r\n")
+            else:
+                f.write(host + "\n")
+
+VARIANTS = ('text', 'mmap', 'parallel')
+
+def run_variant(variant, input_path, output_path):
+    import cleaning
+    func = {
+        'text': cleaning.process_file_content_text,
+        'mmap': cleaning.process_file_content_mmap,
+        'parallel': cleaning.process_file_content_parallel,
+    }[variant]
+    if variant == 'parallel':
+        executor = cleaning.get_clean_executor()
+        list(executor.map(abs, range(cleaning.PARALLEL_CLEAN_WORKERS)))
+    start = time.perf_counter()
+    result = func(input_path, output_path)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'variant': variant,
+        'seconds': elapsed,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'result': result,
+    }))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=2_000_000)
+    parser.add_argument('--workers', type=int, default=0, help="parallel workers (default: CPU count)")
+    parser.add_argument('--run', nargs=3, metavar=('VARIANT', 'INPUT', 'OUTPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.run:
+        run_variant(*args.run)
+        return
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, 'input.txt')
+        generate_input(input_path, args.lines)
+        print(f"Input: {args.lines:,} lines, {os.path.getsize(input_path) / (1024 * 1024):.1f} MB")
+        
+        env = dict(os.environ)
+        if args.workers:
+            env['PARALLEL_CLEAN_WORKERS'] = str(args.workers)
+        
+        seconds = {}
+        for variant in VARIANTS:
+            output_path = os.path.join(tmp_dir, f'{variant}.out')
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', variant, input_path, output_path],
+                capture_output=True, text=True, check=True, env=env
+            )
+            stats = json.loads(proc.stdout.strip().splitlines()[-1])
+            seconds[variant] = stats['seconds']
+            print(f"{variant:>8}: {stats['seconds']:.3f}s  peak RSS {stats['peak_rss_kb'] / 1024:.1f} MB  result {stats['result']}")
+        
+        # Compared only after both runs: a forked child inherits the parent's
+        # peak RSS, so the parent must stay small while the variants run.
+        identical = all(
+            filecmp.cmp(os.path.join(tmp_dir, 'text.out'), os.path.join(tmp_dir, f'{variant}.out'), shallow=False)
+            for variant in VARIANTS
+        )
+        print(f"Identical output: {identical}")
+        print(f"Parallel speedup over mmap: {seconds['mmap'] / seconds['parallel']:.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark config lookups (what load_ftp_config does on every button press)
+on the plain JSON store against the encrypted store.
+
+Compared per lookup:
+- json: today's path, ftp_config.json read and parsed on every call
+- encrypted, naive: scrypt key derivation + AES-GCM decrypt on every call
+- encrypted, no cache: key derived once, every call reads and decrypts
+- encrypted, cached: EncryptedStateBackend with its decrypted-record cache,
+  on the json backend (single process) and on sqlite (shared, where each
+  hit still checks the stored ciphertext)
+
+Needs the cryptography package (pip install cryptography).
+
+Usage: python benchmarks/bench_config_store.py [--users N] [--lookups N]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+from config_crypto import ConfigCipher, derive_key
+
+MASTER_KEY = 'benchmark master key'
+
+def make_config(user_id):
+    return {
+        'host': f"ftp{user_id}.example.com",
+        'port': 21,
+        'user': f"user{user_id}",
+        'pass': f"secret-{user_id}",
+        'path': f"/public_html/v1/pullzone{user_id}",
+    }
+
+def measure(lookup, keys, lookups):
+    samples = []
+    for key in random.Random(1).choices(keys, k=lookups):
+        started = time.perf_counter()
+        value = lookup(key)
+        samples.append(time.perf_counter() - started)
+        assert value == make_config(key), key
+    samples.sort()
+    return statistics.mean(samples), samples[len(samples) * 99 // 100]
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--lookups', type=int, default=5000)
+    args = parser.parse_args()
+    
+    work = tempfile.mkdtemp()
+    keys = [str(100000 + i) for i in range(args.users)]
+    cipher = ConfigCipher(MASTER_KEY)
+    
+    plain = main.JSONStateBackend(os.path.join(work, 'plain.json'))
+    encrypted_json = main.JSONStateBackend(os.path.join(work, 'encrypted.json'))
+    cached_json = main.EncryptedStateBackend(encrypted_json, cipher, shared=False)
+    cached_sqlite = main.EncryptedStateBackend(
+        main.SQLiteStateBackend(os.path.join(work, 'state.db')), cipher, shared=True
+    )
+    configs = {key: make_config(key) for key in keys}
+    plain.write_configs(configs)
+    encrypted_json.write_configs({key: cipher.encrypt('config', key, value) for key, value in configs.items()})
+    for key, value in configs.items():
+        cached_sqlite.set('config', key, value)
+    
+    def naive(key):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        
+        per_call = ConfigCipher.__new__(ConfigCipher)
+        per_call.aead = AESGCM(derive_key(MASTER_KEY))
+        return json.loads(per_call.decrypt_json('config', key, encrypted_json.get('config', key)))
+    
+    def uncached(key):
+        return json.loads(cipher.decrypt_json('config', key, encrypted_json.get('config', key)))
+    
+    print(f"{args.users} configs, {args.lookups} lookups")
+    runs = [
+        ('json (current)', lambda key: plain.get('config', key), args.lookups),
+        ('encrypted, naive per-read KDF', naive, min(args.lookups, 50)),
+        ('encrypted, no cache', uncached, args.lookups),
+        ('encrypted, cached (json)', lambda key: cached_json.get('config', key), args.lookups),
+        ('encrypted, cached (sqlite)', lambda key: cached_sqlite.get('config', key), args.lookups),
+    ]
+    for name, lookup, lookups in runs:
+        if lookup is not naive:
+            for key in keys:
+                lookup(key)
+        mean, p99 = measure(lookup, keys, lookups)
+        print(f"{name:32s} mean {mean * 1e6:9.1f} us  p99 {p99 * 1e6:9.1f} us")
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,121 @@
+"""
+Benchmark single- vs multi-stream FTPS uploads (main.store_file) against a
+local pyftpdlib server.
+
+The server runs in its own process and simulates a distant host: every
+control reply is delayed by --latency seconds and each data connection is
+capped at --stream-rate MB/s, the way a long TCP/TLS path caps one stream.
+Like vsftpd it accepts REST past the end of the file, which multi-stream
+uploads need. Each uploaded file is compared with the original.
+
+Needs pyftpdlib and pyOpenSSL (pip install pyftpdlib pyopenssl) and the
+openssl command for the throwaway certificate.
+
+Usage: python benchmarks/bench_ftp_upload.py [--size-mb N] [--streams 1,2,4,8]
+"""
+import argparse
+import filecmp
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+
+PORT = 2122
+USER, PASSWORD = 'bench', 'bench'
+
+def run_server(root, certfile, latency, stream_rate):
+    import logging
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import TLS_DTPHandler, TLS_FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    
+    logging.basicConfig(level=logging.WARNING)
+    
+    class DTPHandler(TLS_DTPHandler, ThrottledDTPHandler):
+        read_limit = int(stream_rate * 1024 * 1024)
+    
+    class FTPHandler(TLS_FTPHandler):
+        def respond(self, resp, logfun=None):
+            time.sleep(latency)
+            return super().respond(resp)
+        
+        def ftp_STOR(self, file, mode='w'):
+            # Allow REST past the end of the file by extending it first.
+            if self._restart_position and os.path.exists(file):
+                if os.path.getsize(file) < self._restart_position:
+                    os.truncate(file, self._restart_position)
+            return super().ftp_STOR(file, mode)
+    
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USER, PASSWORD, root, perm='elradfmwMT')
+    FTPHandler.authorizer = authorizer
+    FTPHandler.certfile = certfile
+    FTPHandler.tls_control_required = True
+    FTPHandler.tls_data_required = True
+    FTPHandler.dtp_handler = DTPHandler
+    ThreadedFTPServer(('127.0.0.1', PORT), FTPHandler).serve_forever()
+
+def make_certificate(directory):
+    key, cert = os.path.join(directory, 'key.pem'), os.path.join(directory, 'cert.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+         '-days', '1', '-subj', '/CN=localhost'],
+        check=True, capture_output=True
+    )
+    combined = os.path.join(directory, 'combined.pem')
+    with open(combined, 'wb') as out:
+        for path in (key, cert):
+            with open(path, 'rb') as f:
+                out.write(f.read())
+    return combined
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--streams', default='1,2,4,8')
+    parser.add_argument('--latency', type=float, default=0.04, help="seconds added to every control reply")
+    parser.add_argument('--stream-rate', type=float, default=8, help="MB/s per data connection")
+    args = parser.parse_args()
+    
+    work = tempfile.mkdtemp()
+    root = os.path.join(work, 'root')
+    os.makedirs(os.path.join(root, 'pz'))
+    certfile = make_certificate(work)
+    server = multiprocessing.Process(
+        target=run_server, args=(root, certfile, args.latency, args.stream_rate), daemon=True
+    )
+    server.start()
+    time.sleep(1)
+    
+    source = os.path.join(work, 'source.txt')
+    with open(source, 'wb') as f:
+        for i in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+    
+    config = {'host': '127.0.0.1', 'port': PORT, 'user': USER, 'pass': PASSWORD, 'path': '/pz'}
+    main.MULTI_STREAM_MIN_PART_BYTES = 1024 * 1024
+    print(f"{args.size_mb} MB, {args.stream_rate} MB/s per data connection, "
+          f"{args.latency * 1000:.0f} ms per control reply")
+    try:
+        for streams in (int(value) for value in args.streams.split(',')):
+            ftp = main.open_ftp_session(config)
+            try:
+                start = time.perf_counter()
+                used = main.store_file(ftp, dict(config, upload_streams=streams), source, 'upload.tmp')
+                seconds = time.perf_counter() - start
+            finally:
+                main.close_ftp_session(ftp)
+            identical = filecmp.cmp(source, os.path.join(root, 'pz', 'upload.tmp'), shallow=False)
+            print(f"{used:3d} streams: {seconds:6.2f}s  {args.size_mb / seconds:6.1f} MB/s  identical: {identical}")
+    finally:
+        server.terminate()
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,148 @@
+"""
+Benchmark TelegramRateLimiter against a local fake Bot API.
+
+The fake API answers sendMessage/editMessageText after a fixed latency and
+enforces Telegram-like flood limits (per chat and per bot, over a rolling
+one-second window), answering 429 with retry_after when they're exceeded.
+Each simulated user runs the upload_file message pattern: one reply, a
+series of progress edits (marked via rate_limit_args), then a final edit
+with the menu keyboard.
+
+Usage: python benchmarks/bench_rate_limiter.py [--users N] [--edits N]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+import main
+
+class FakeBotAPI(BaseRequest):
+    def __init__(self, latency=0.03, chat_limit=5, global_limit=30, retry_after=1):
+        self.latency = latency
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.retry_after = retry_after
+        self.chat_calls = collections.defaultdict(collections.deque)
+        self.global_calls = collections.deque()
+        self.message_ids = 0
+        self.requests = 0
+        self.rejected = 0
+    
+    @property
+    def read_timeout(self):
+        return 5.0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def over_limit(self, calls, limit, now):
+        while calls and now - calls[0] > 1.0:
+            calls.popleft()
+        return len(calls) >= limit
+    
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        await asyncio.sleep(self.latency)
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        
+        if endpoint == 'getMe':
+            return 200, json.dumps({'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'
+            }}).encode()
+        
+        self.requests += 1
+        chat_id = int(params['chat_id'])
+        now = time.monotonic()
+        chat_calls = self.chat_calls[chat_id]
+        if self.over_limit(chat_calls, self.chat_limit, now) or self.over_limit(self.global_calls, self.global_limit, now):
+            self.rejected += 1
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }).encode()
+        chat_calls.append(now)
+        self.global_calls.append(now)
+        
+        if endpoint == 'sendMessage':
+            self.message_ids += 1
+            message_id = self.message_ids
+        else:
+            message_id = int(params['message_id'])
+        return 200, json.dumps({'ok': True, 'result': {
+            'message_id': message_id, 'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', ''),
+        }}).encode()
+
+async def simulate_user(bot, chat_id, edits, step):
+    start = time.monotonic()
+    # ExtBot rejects rate_limit_args without a rate limiter.
+    progress_args = {'rate_limit_args': {'progress': True}} if bot.rate_limiter else {}
+    try:
+        message = await bot.send_message(chat_id, "⬇️ Downloading file...")
+        for index in range(edits):
+            await asyncio.sleep(step)
+            await bot.edit_message_text(
+                f"Step {index + 1}/{edits}...", chat_id=chat_id, message_id=message.message_id, **progress_args
+            )
+        await bot.edit_message_text(
+            "✅ Upload Successful!", chat_id=chat_id, message_id=message.message_id,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Back to Menu", callback_data="menu_main")]])
+        )
+        return time.monotonic() - start, None
+    except RetryAfter as e:
+        return time.monotonic() - start, e
+
+async def run(users, edits, step, limited):
+    api = FakeBotAPI()
+    limiter = main.TelegramRateLimiter() if limited else None
+    bot = ExtBot('123:bench', request=api, get_updates_request=FakeBotAPI(), rate_limiter=limiter)
+    async with bot:
+        start = time.monotonic()
+        results = await asyncio.gather(*(simulate_user(bot, 1000 + i, edits, step) for i in range(users)))
+        wall = time.monotonic() - start
+    
+    latencies = sorted(seconds for seconds, error in results if error is None)
+    failed = sum(1 for _, error in results if error is not None)
+    label = 'rate limiter' if limited else 'no limiter'
+    print(f"{label}:")
+    print(f"  uploads failed with RetryAfter: {failed}/{users}")
+    print(f"  API requests: {api.requests}  (429 responses: {api.rejected})")
+    if latencies:
+        print(f"  time to final message: p50 {statistics.median(latencies):.2f}s  "
+              f"p95 {latencies[int(len(latencies) * 0.95) - 1 if len(latencies) > 1 else 0]:.2f}s")
+    print(f"  wall time: {wall:.2f}s")
+    if limiter:
+        print(f"  limiter stats: {limiter.stats}")
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--edits', type=int, default=6)
+    parser.add_argument('--step', type=float, default=0.05, help="seconds of work between progress edits")
+    args = parser.parse_args()
+    
+    print(f"{args.users} concurrent uploads, {args.edits} progress edits each")
+    asyncio.run(run(args.users, args.edits, args.step, limited=False))
+    asyncio.run(run(args.users, args.edits, args.step, limited=True))
+
+if __name__ == '__main__':
+    main_cli()
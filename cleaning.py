@@ -0,0 +1,564 @@
+"""
+URL list cleaning engine.
+
+Kept out of main.py so the bot only pays for it when a file is uploaded, and
+so the cleaning worker processes don't have to import the Telegram and Flask
+stacks.
+"""
+import os
+import re
+import logging
+import mmap
+import io
+import shutil
+import multiprocessing
+import ipaddress
+import contextlib
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+def clean_url_line(line):
+    """
+    Clean a line by removing http://, https://, www., and trailing paths/slashes.
+    Returns just the hostname.
+    """
+    line = line.strip()
+    if not line:
+        return line
+    
+    line = re.sub(r'^https?://', '', line, flags=re.IGNORECASE)
+    line = re.sub(r'^www\.', '', line, flags=re.IGNORECASE)
+    line = re.sub(r'/.*$', '', line)
+    line = line.strip()
+    
+    return line
+
+CLEAN_LINE_PATTERN = re.compile(
+    rb'[ \t\x0b\x0c\r]*'
+    rb'(?P<scheme>(?i:https?://))?'
+    rb'(?P<www>(?i:www\.))?'
+    rb'[ \t\x0b\x0c\r]*'
+    rb'(?P<host>[^\s/](?:[^\n/]*[^\s/])?)?'
+    rb'[ \t\x0b\x0c\r]*'
+    rb'(?P<path>/[^\n]*)?'
+    rb'\n?'
+)
+
+# Anything the bytes path can't reproduce exactly: non-ASCII bytes (decoded
+# with errors='ignore' and stripped as unicode whitespace), ASCII separator
+# characters that str.strip() removes, and bare carriage returns that text
+# mode treats as line breaks.
+TEXT_FALLBACK_PATTERN = re.compile(rb'[\x80-\xff\x1c-\x1f]|\r(?!\n)')
+
+WRITE_BATCH_LINES = 8192
+SCAN_WINDOW_BYTES = 1024 * 1024
+
+# Inputs at least this large are split at line boundaries and cleaned on a
+# pool of worker processes; smaller ones aren't worth the IPC overhead.
+PARALLEL_CLEAN_THRESHOLD_BYTES = int(os.environ.get('PARALLEL_CLEAN_THRESHOLD_MB', '8')) * 1024 * 1024
+PARALLEL_CLEAN_WORKERS = int(os.environ.get('PARALLEL_CLEAN_WORKERS', '0')) or (os.cpu_count() or 1)
+PARALLEL_CHUNKS_PER_WORKER = 2
+
+clean_executor = None
+clean_executor_lock = Lock()
+
+# RFC 1123 hostname: at least two labels of letters, digits and inner
+# hyphens, up to 63 characters each, and a top-level label starting with a
+# letter (which also keeps dotted-quad IPs off the fast path).
+HOSTNAME_PATTERN = re.compile(
+    rb'(?i:(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,62}(?<!-))'
+)
+HOSTNAME_WITH_PORT_PATTERN = re.compile(rb'[^:]+:\d{1,5}')
+MAX_HOSTNAME_LENGTH = 253
+
+VALIDATE_HOSTNAMES = os.environ.get('VALIDATE_HOSTNAMES', '1') != '0'
+ALLOW_IP_HOSTS = os.environ.get('ALLOW_IP_HOSTS', '1') != '0'
+DENIED_IP_NETWORKS = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.environ.get('DENIED_IP_NETWORKS', '').split(',')
+    if network.strip()
+]
+PUBLIC_SUFFIX_LIST_FILE = os.environ.get('PUBLIC_SUFFIX_LIST_FILE')
+
+public_suffixes = None
+
+def load_public_suffixes():
+    """
+    Load the public suffix list from PUBLIC_SUFFIX_LIST_FILE once per process.
+    Returns (rules, wildcards, exceptions) as sets of lowercase ASCII bytes,
+    or None if no list is configured.
+    """
+    global public_suffixes
+    if public_suffixes is not None or not PUBLIC_SUFFIX_LIST_FILE:
+        return public_suffixes or None
+    
+    rules, wildcards, exceptions = set(), set(), set()
+    try:
+        with open(PUBLIC_SUFFIX_LIST_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                rule = line.split(None, 1)[0] if line.strip() else ''
+                if not rule or rule.startswith('//'):
+                    continue
+                try:
+                    if rule.startswith('!'):
+                        exceptions.add(rule[1:].encode('idna').lower())
+                    elif rule.startswith('*.'):
+                        wildcards.add(rule[2:].encode('idna').lower())
+                    else:
+                        rules.add(rule.encode('idna').lower())
+                except UnicodeError:
+                    continue
+        logger.info(f"Loaded {len(rules) + len(wildcards)} public suffix rules")
+    except Exception as e:
+        logger.error(f"Error loading public suffix list: {e}")
+    
+    public_suffixes = (rules, wildcards, exceptions)
+    return public_suffixes
+
+def is_public_suffix(host, suffixes):
+    """
+    True if host (bytes) is itself a public suffix, e.g. b'co.uk'.
+    """
+    rules, wildcards, exceptions = suffixes
+    host = host.lower()
+    if host in exceptions:
+        return False
+    return host in rules or host.partition(b'.')[2] in wildcards
+
+def hostname_rejection(buffer, start, end, suffixes):
+    """
+    Validate buffer[start:end] as a pullzone hostname.
+    Returns None if the hostname is accepted, else a short rejection reason.
+    """
+    if end - start <= MAX_HOSTNAME_LENGTH and HOSTNAME_PATTERN.fullmatch(buffer, start, end):
+        if suffixes and is_public_suffix(buffer[start:end], suffixes):
+            return 'public_suffix'
+        return None
+    return classify_rejected_host(buffer[start:end])
+
+def classify_rejected_host(host):
+    """
+    Slow path for hosts that fail the hostname grammar: IPs are checked
+    against the IP policy, everything else gets a reason for the report.
+    """
+    try:
+        ip = ipaddress.ip_address(host.decode('ascii'))
+    except (UnicodeDecodeError, ValueError):
+        ip = None
+    
+    if ip is not None:
+        if not ALLOW_IP_HOSTS or any(ip in network for network in DENIED_IP_NETWORKS):
+            return 'ip_denied'
+        return None
+    
+    if any(c in host for c in b' \t\x0b\x0c\r'):
+        return 'whitespace'
+    if b'@' in host:
+        return 'userinfo'
+    if b'?' in host or b'#' in host:
+        return 'query'
+    if HOSTNAME_WITH_PORT_PATTERN.fullmatch(host):
+        return 'port'
+    if len(host) > MAX_HOSTNAME_LENGTH:
+        return 'too_long'
+    if b'.' not in host:
+        return 'single_label'
+    return 'invalid'
+
+def write_rejection(rejected_file, line_number, reason, line):
+    """
+    Append one "line<TAB>reason<TAB>content" record to the rejection report.
+    """
+    if rejected_file:
+        rejected_file.write(b'%d\t%s\t%s\n' % (line_number, reason.encode(), line))
+
+def format_rejections(rejections):
+    """
+    Human-readable rejection counters, most frequent reason first.
+    """
+    return ', '.join(
+        f"{reason.replace('_', ' ')}: {count}"
+        for reason, count in sorted(rejections.items(), key=lambda item: -item[1])
+    )
+
+def process_file_content(input_path, output_path, rejected_path=None):
+    """
+    Process file to clean URLs - remove http://, https://, www., and paths,
+    then drop lines that aren't valid hostnames (listed in rejected_path).
+    Large inputs are cleaned in parallel, the rest on the mmap bytes path
+    (which falls back to the text path when needed).
+    Returns tuple: (lines_processed, lines_cleaned, rejections) where
+    rejections maps each rejection reason to its count.
+    """
+    try:
+        if PARALLEL_CLEAN_WORKERS > 1 and os.path.getsize(input_path) >= PARALLEL_CLEAN_THRESHOLD_BYTES:
+            return process_file_content_parallel(input_path, output_path, rejected_path)
+        return process_file_content_mmap(input_path, output_path, rejected_path)
+    except Exception as e:
+        logger.error(f"Error processing file content: {e}")
+        raise
+
+def clean_text_lines(infile, outfile, rejected_file=None):
+    """
+    Clean lines from a text stream into another, one clean_url_line call per line.
+    Returns tuple: (lines_processed, lines_cleaned, rejections)
+    """
+    lines_processed = 0
+    lines_cleaned = 0
+    rejections = {}
+    suffixes = load_public_suffixes() if VALIDATE_HOSTNAMES else None
+    
+    for line in infile:
+        lines_processed += 1
+        original = line.strip()
+        cleaned = clean_url_line(original)
+        
+        if cleaned and VALIDATE_HOSTNAMES:
+            host = cleaned.encode('utf-8')
+            reason = hostname_rejection(host, 0, len(host), suffixes)
+            if reason:
+                rejections[reason] = rejections.get(reason, 0) + 1
+                write_rejection(rejected_file, lines_processed, reason, original.encode('utf-8'))
+                continue
+        
+        if cleaned and cleaned != original:
+            lines_cleaned += 1
+        
+        if cleaned:
+            outfile.write(cleaned + '\n')
+    
+    return lines_processed, lines_cleaned, rejections
+
+def process_file_content_text(input_path, output_path, rejected_path=None):
+    """
+    Line-by-line text mode cleaning. Reference implementation and fallback
+    for inputs the mmap path can't handle byte-for-byte.
+    Returns tuple: (lines_processed, lines_cleaned, rejections)
+    """
+    with open(input_path, 'r', encoding='utf-8', errors='ignore') as infile:
+        with open(output_path, 'w', encoding='utf-8') as outfile:
+            with open_rejected_file(rejected_path) as rejected_file:
+                return clean_text_lines(infile, outfile, rejected_file)
+
+def open_rejected_file(rejected_path):
+    """
+    Open the rejection report for writing, or a null context if not wanted.
+    """
+    if rejected_path:
+        return open(rejected_path, 'wb')
+    return contextlib.nullcontext()
+
+def release_mapped_pages(mm, released, offset):
+    """
+    Drop already-scanned pages of a read-only mapping so RSS stays bounded
+    on large inputs. Returns the new released offset.
+    """
+    offset -= offset % mmap.PAGESIZE
+    if offset > released and hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_DONTNEED, released, offset - released)
+        return offset
+    return released
+
+def process_file_content_mmap(input_path, output_path, rejected_path=None):
+    """
+    Bytes-native cleaning: maps the input and writes hostname slices straight
+    from the mapping, without decoding lines into str.
+    Output is identical to process_file_content_text.
+    Returns tuple: (lines_processed, lines_cleaned, rejections)
+    """
+    return process_file_range(input_path, output_path, 0, None, rejected_path)
+
+def process_file_range(input_path, output_path, start, end, rejected_path=None):
+    """
+    Clean bytes [start, end) of input_path into output_path on the mmap path,
+    falling back to the text path for that range when needed. start must be
+    0 or just past a newline; end=None means end of file. Line numbers in
+    the rejection report are relative to start.
+    Returns tuple: (lines_processed, lines_cleaned, rejections)
+    """
+    with open(input_path, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            open(output_path, 'wb').close()
+            with open_rejected_file(rejected_path):
+                pass
+            return 0, 0, {}
+        
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            
+            # Pre-pass in fixed windows: count lines and make sure the bytes
+            # path applies, without keeping the whole range resident.
+            lines_processed = 0
+            released = start - start % mmap.PAGESIZE
+            for offset in range(start, end, SCAN_WINDOW_BYTES):
+                window_end = min(offset + SCAN_WINDOW_BYTES, end)
+                # One byte of overlap so a \r\n split across windows isn't
+                # mistaken for a bare \r.
+                window = mm[offset:window_end + 1]
+                match = TEXT_FALLBACK_PATTERN.search(window)
+                if match and match.start() < window_end - offset:
+                    logger.info("Input is not plain ASCII, using text cleaning path")
+                    return process_mapped_range_text(mm, input_path, output_path, start, end, rejected_path)
+                lines_processed += window.count(b'\n', 0, window_end - offset)
+                released = release_mapped_pages(mm, released, window_end)
+            if mm[end - 1:end] != b'\n':
+                lines_processed += 1
+            
+            lines_cleaned = 0
+            line_number = 0
+            rejections = {}
+            validate = VALIDATE_HOSTNAMES
+            suffixes = load_public_suffixes() if validate else None
+            fullmatch = HOSTNAME_PATTERN.fullmatch
+            released = start - start % mmap.PAGESIZE
+            view = memoryview(mm)
+            batch = []
+            try:
+                with open(output_path, 'wb') as outfile, open_rejected_file(rejected_path) as rejected_file:
+                    for match in CLEAN_LINE_PATTERN.finditer(mm, start, end):
+                        line_number += 1
+                        host_start, host_end = match.span('host')
+                        if host_start == host_end:
+                            continue
+                        
+                        # Inline fast path; hostname_rejection re-checks and
+                        # classifies the (rare) lines that fail it.
+                        if validate and (
+                            suffixes
+                            or host_end - host_start > MAX_HOSTNAME_LENGTH
+                            or not fullmatch(mm, host_start, host_end)
+                        ):
+                            reason = hostname_rejection(mm, host_start, host_end, suffixes)
+                            if reason:
+                                rejections[reason] = rejections.get(reason, 0) + 1
+                                write_rejection(rejected_file, line_number, reason, mm[match.start():match.end()].strip())
+                                continue
+                        
+                        if match.start('scheme') >= 0 or match.start('www') >= 0 or match.start('path') >= 0:
+                            lines_cleaned += 1
+                        
+                        batch.append(view[host_start:host_end])
+                        batch.append(b'\n')
+                        if len(batch) >= WRITE_BATCH_LINES * 2:
+                            outfile.writelines(batch)
+                            batch.clear()
+                            released = release_mapped_pages(mm, released, match.end())
+                    
+                    outfile.writelines(batch)
+            finally:
+                batch.clear()
+                view.release()
+    
+    return lines_processed, lines_cleaned, rejections
+
+def process_mapped_range_text(mm, input_path, output_path, start, end, rejected_path=None):
+    """
+    Text path for one byte range of a mapping. Ranges start just past a
+    newline, so decoding them separately matches decoding the whole file.
+    """
+    if start == 0 and end == len(mm):
+        return process_file_content_text(input_path, output_path, rejected_path)
+    
+    with io.TextIOWrapper(io.BytesIO(mm[start:end]), encoding='utf-8', errors='ignore') as infile:
+        with open(output_path, 'w', encoding='utf-8') as outfile:
+            with open_rejected_file(rejected_path) as rejected_file:
+                return clean_text_lines(infile, outfile, rejected_file)
+
+def split_line_ranges(input_path, count, start=0, end=None):
+    """
+    Split bytes [start, end) of a file into at most count byte ranges that
+    each end just past a newline (or at end). start must be 0 or just past
+    a newline; end=None means end of file.
+    """
+    size = os.path.getsize(input_path) if end is None else end
+    if size <= start:
+        return []
+    
+    target = max((size - start) // count, 1)
+    ranges = []
+    with open(input_path, 'rb') as infile:
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while start < size:
+                newline = mm.find(b'\n', min(start + target, size) - 1, size)
+                end = size if newline == -1 else newline + 1
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+def get_clean_executor():
+    """
+    Worker pool for parallel cleaning, created on first use and reused across
+    uploads. Uses forkserver where available so workers aren't forked from a
+    process that already runs the Flask and bot threads.
+    """
+    global clean_executor
+    with clean_executor_lock:
+        if clean_executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            clean_executor = ProcessPoolExecutor(max_workers=PARALLEL_CLEAN_WORKERS, mp_context=context)
+            logger.info(f"Started cleaning pool with {PARALLEL_CLEAN_WORKERS} workers")
+        return clean_executor
+
+def replace_clean_executor(broken):
+    """
+    Drop the pool after a worker died (BrokenProcessPool: OOM kill, crash) and
+    return a fresh one. A pool that was already replaced by another upload
+    is left alone.
+    """
+    global clean_executor
+    with clean_executor_lock:
+        if clean_executor is broken:
+            clean_executor = None
+            broken.shutdown(wait=False, cancel_futures=True)
+            logger.warning("Cleaning pool is broken, starting a new one")
+    return get_clean_executor()
+
+def clean_ranges_on_pool(executor, jobs):
+    futures = [executor.submit(process_file_range, *job) for job in jobs]
+    return [future.result() for future in futures]
+
+def process_file_content_parallel(input_path, output_path, rejected_path=None, executor=None):
+    """
+    Clean a large file on the worker pool: split at line boundaries, clean each
+    range into a part file, then concatenate the parts in order.
+    Output and counts are identical to process_file_content_mmap.
+    Returns tuple: (lines_processed, lines_cleaned, rejections)
+    """
+    ranges = split_line_ranges(input_path, PARALLEL_CLEAN_WORKERS * PARALLEL_CHUNKS_PER_WORKER)
+    with open(output_path, 'wb') as outfile, open_rejected_file(rejected_path) as rejected_file:
+        result = clean_ranges(input_path, ranges, outfile, rejected_file, 0, executor or get_clean_executor())
+    logger.info(f"Cleaned {len(ranges)} chunks in parallel")
+    return result
+
+def clean_ranges(input_path, ranges, outfile, rejected_file=None, line_offset=0, executor=None):
+    """
+    Clean line-aligned byte ranges of input_path into part files (on the
+    worker pool if an executor is given, otherwise, or if the pool keeps
+    breaking, in this thread) and append the parts in order to the open
+    outfile / rejected_file. Report line numbers are shifted by line_offset
+    plus the lines of preceding ranges.
+    Returns tuple: (lines_processed, lines_cleaned, rejections)
+    """
+    part_paths = [f"{outfile.name}.part{index}" for index in range(len(ranges))]
+    rejected_part_paths = [f"{path}.rejected" if rejected_file else None for path in part_paths]
+    
+    jobs = [
+        (input_path, part_path, start, end, rejected_part_path)
+        for part_path, rejected_part_path, (start, end) in zip(part_paths, rejected_part_paths, ranges)
+    ]
+    
+    try:
+        results = None
+        if executor:
+            # Part files are rewritten from scratch, so a range can simply be
+            # cleaned again after a failed attempt.
+            try:
+                results = clean_ranges_on_pool(executor, jobs)
+            except BrokenProcessPool:
+                try:
+                    results = clean_ranges_on_pool(replace_clean_executor(executor), jobs)
+                except BrokenProcessPool:
+                    logger.warning("Cleaning pool broke again, cleaning in this thread instead")
+        if results is None:
+            results = [process_file_range(*job) for job in jobs]
+        
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, outfile, SCAN_WINDOW_BYTES)
+        
+        if rejected_file:
+            # Report line numbers are relative to each range; shift them by
+            # the lines in all preceding ranges.
+            for rejected_part_path, (processed, _, _) in zip(rejected_part_paths, results):
+                with open(rejected_part_path, 'rb') as part:
+                    for record in part:
+                        line_number, rest = record.split(b'\t', 1)
+                        rejected_file.write(b'%d\t%s' % (int(line_number) + line_offset, rest))
+                line_offset += processed
+        
+        lines_processed = sum(processed for processed, _, _ in results)
+        lines_cleaned = sum(cleaned for _, cleaned, _ in results)
+        rejections = {}
+        for _, _, part_rejections in results:
+            for reason, count in part_rejections.items():
+                rejections[reason] = rejections.get(reason, 0) + count
+        return lines_processed, lines_cleaned, rejections
+    finally:
+        for path in part_paths + rejected_part_paths:
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+# While a file is still downloading, cleaning waits for at least this many
+# new bytes before taking the next range, so ranges aren't too small.
+STREAM_CLEAN_MIN_BYTES = 1024 * 1024
+
+class StreamingCleaner:
+    """
+    Clean a file while it is still being written: feed() cleans every
+    complete line that has arrived so far, finish() the rest once the file
+    is complete. Output and counts are identical to process_file_content.
+    Not thread-safe; call feed/finish from one thread at a time.
+    """
+    
+    def __init__(self, input_path, output_path, rejected_path=None):
+        self.input_path = input_path
+        self.offset = 0
+        self.lines_processed = 0
+        self.lines_cleaned = 0
+        self.rejections = {}
+        self.outfile = open(output_path, 'wb')
+        self.rejected_file = open(rejected_path, 'wb') if rejected_path else None
+    
+    def feed(self, available, final=False):
+        """
+        Clean the lines in [offset, available). Unless final, a trailing
+        partial line is left for the next call.
+        """
+        if not final:
+            if available - self.offset < STREAM_CLEAN_MIN_BYTES:
+                return
+            with open(self.input_path, 'rb') as infile:
+                with mmap.mmap(infile.fileno(), available, access=mmap.ACCESS_READ) as mm:
+                    available = mm.rfind(b'\n', self.offset, available) + 1
+        if available <= self.offset:
+            return
+        
+        if available - self.offset >= PARALLEL_CLEAN_THRESHOLD_BYTES and PARALLEL_CLEAN_WORKERS > 1:
+            count = PARALLEL_CLEAN_WORKERS * PARALLEL_CHUNKS_PER_WORKER
+            ranges = split_line_ranges(self.input_path, count, self.offset, available)
+            executor = get_clean_executor()
+        else:
+            ranges = [(self.offset, available)]
+            executor = None
+        
+        processed, cleaned, rejections = clean_ranges(
+            self.input_path, ranges, self.outfile, self.rejected_file, self.lines_processed, executor
+        )
+        self.lines_processed += processed
+        self.lines_cleaned += cleaned
+        for reason, count in rejections.items():
+            self.rejections[reason] = self.rejections.get(reason, 0) + count
+        self.offset = available
+    
+    def finish(self):
+        """
+        Clean whatever is left of the (now complete) file and close the outputs.
+        Returns tuple: (lines_processed, lines_cleaned, rejections)
+        """
+        try:
+            self.feed(os.path.getsize(self.input_path), final=True)
+        finally:
+            self.close()
+        return self.lines_processed, self.lines_cleaned, self.rejections
+    
+    def close(self):
+        self.outfile.close()
+        if self.rejected_file:
+            self.rejected_file.close()
@@ -0,0 +1,68 @@
+"""
+Encryption at rest for saved FTP configs.
+
+Records are sealed with AES-256-GCM (an AEAD) and bound to their namespace
+and key, so a record copied to another user's entry fails to decrypt. The
+key is derived from CONFIG_MASTER_KEY with scrypt once per process;
+deriving it on every read would add tens of milliseconds to each button
+press. Needs the optional cryptography package.
+"""
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Changing the salt (or the master key) makes existing records unreadable.
+CONFIG_KEY_SALT = os.environ.get('CONFIG_KEY_SALT', 'ftppullzonebot-config-v1')
+
+SCRYPT_N = 2 ** 15
+SCRYPT_R = 8
+SCRYPT_P = 1
+NONCE_BYTES = 12
+RECORD_PREFIX = 'enc:v1:'
+
+def derive_key(master_key, salt=CONFIG_KEY_SALT):
+    return hashlib.scrypt(
+        master_key.encode('utf-8'), salt=salt.encode('utf-8'),
+        n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, maxmem=64 * 1024 * 1024, dklen=32
+    )
+
+def is_encrypted(record):
+    return isinstance(record, str) and record.startswith(RECORD_PREFIX)
+
+class ConfigCipher:
+    """
+    Seals JSON values into 'enc:v1:<base64 nonce + ciphertext>' strings.
+    """
+    
+    def __init__(self, master_key):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        
+        started = time.perf_counter()
+        self.aead = AESGCM(derive_key(master_key))
+        logger.info(f"Derived config encryption key in {(time.perf_counter() - started) * 1000:.0f} ms")
+    
+    def encrypt(self, namespace, key, value):
+        nonce = os.urandom(NONCE_BYTES)
+        sealed = self.aead.encrypt(nonce, json.dumps(value).encode('utf-8'), f"{namespace}:{key}".encode('utf-8'))
+        return RECORD_PREFIX + base64.b64encode(nonce + sealed).decode('ascii')
+    
+    def decrypt_json(self, namespace, key, record):
+        """
+        The JSON text sealed in record. Raises ValueError if it can't be
+        decrypted (wrong CONFIG_MASTER_KEY / CONFIG_KEY_SALT, or tampered).
+        """
+        from cryptography.exceptions import InvalidTag
+        
+        data = base64.b64decode(record[len(RECORD_PREFIX):])
+        try:
+            plaintext = self.aead.decrypt(
+                data[:NONCE_BYTES], data[NONCE_BYTES:], f"{namespace}:{key}".encode('utf-8')
+            )
+        except InvalidTag:
+            raise ValueError(f"Can't decrypt {namespace} record {key}: wrong CONFIG_MASTER_KEY or tampered record") from None
+        return plaintext.decode('utf-8')
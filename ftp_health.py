@@ -0,0 +1,177 @@
+"""
+Per-host FTP health: latency and error tracking, adaptive timeouts and a
+circuit breaker.
+
+Connects, logins and uploads are recorded per host:port. Instead of a fixed
+30 s, the connect timeout follows the host's observed connect/login
+latency, so a dead host that normally answers in 50 ms fails within
+seconds, and the transfer timeout grows with the file size on hosts that
+have been slow, so a slow but alive host isn't cut off mid-STOR. After
+CIRCUIT_FAILURES network errors in a row the circuit opens: calls fail at
+once with HostUnavailable until CIRCUIT_COOLDOWN has passed, then a single
+trial call is let through and closes the circuit again if it succeeds.
+"""
+import time
+import logging
+import contextlib
+from collections import deque
+from ftplib import error_temp
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+MIN_CONNECT_TIMEOUT = 5
+MAX_TRANSFER_TIMEOUT = 600
+# Timeouts are this many times the slow end of what the host has shown.
+TIMEOUT_MULTIPLIER = 4
+# Latency samples needed before the timeouts adapt.
+MIN_SAMPLES = 5
+HEALTH_WINDOW = 50
+# Uploads smaller than this say little about throughput.
+MIN_THROUGHPUT_SAMPLE_BYTES = 256 * 1024
+CIRCUIT_FAILURES = 3
+CIRCUIT_COOLDOWN = 60
+
+# Errors that mean the host (or the path to it) is in trouble. Anything
+# else, such as a refused login, means it answered.
+NETWORK_ERRORS = (OSError, EOFError, error_temp)
+
+class HostUnavailable(Exception):
+    pass
+
+class HostHealth:
+    def __init__(self):
+        self.latencies = {operation: deque(maxlen=HEALTH_WINDOW) for operation in ('connect', 'login', 'transfer')}
+        self.throughputs = deque(maxlen=HEALTH_WINDOW)
+        self.outcomes = deque(maxlen=HEALTH_WINDOW)
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.opened_at = None
+        self.trial_started_at = None
+
+host_health = {}
+health_lock = Lock()
+
+def get_host_health(server):
+    with health_lock:
+        if server not in host_health:
+            host_health[server] = HostHealth()
+        return host_health[server]
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def record_success(server, operation, seconds=None, size=None):
+    health = get_host_health(server)
+    with health_lock:
+        if seconds is not None:
+            health.latencies[operation].append(seconds)
+            if size and size >= MIN_THROUGHPUT_SAMPLE_BYTES and seconds > 0:
+                health.throughputs.append(size / seconds)
+        health.outcomes.append(True)
+        if health.opened_at is not None:
+            logger.info(f"FTP host {server} is reachable again, closing its circuit")
+        health.consecutive_failures = 0
+        health.opened_at = None
+        health.trial_started_at = None
+
+def record_failure(server, operation, error):
+    health = get_host_health(server)
+    with health_lock:
+        health.outcomes.append(False)
+        health.consecutive_failures += 1
+        health.last_error = f"{operation}: {str(error) or type(error).__name__}"
+        health.trial_started_at = None
+        if health.consecutive_failures >= CIRCUIT_FAILURES:
+            if health.opened_at is None:
+                logger.warning(f"FTP host {server} failed {health.consecutive_failures} times in a row, opening its circuit")
+            health.opened_at = time.monotonic()
+
+def check_circuit(server):
+    """
+    Raise HostUnavailable if the host's circuit is open. Once the cooldown
+    has passed, one caller at a time gets through to try the host again.
+    """
+    health = get_host_health(server)
+    with health_lock:
+        if health.opened_at is None:
+            return
+        now = time.monotonic()
+        retry_in = health.opened_at + CIRCUIT_COOLDOWN - now
+        trial_running = health.trial_started_at is not None and now - health.trial_started_at < CIRCUIT_COOLDOWN
+        if retry_in > 0 or trial_running:
+            raise HostUnavailable(
+                f"{server} is marked down after {health.consecutive_failures} failed attempts "
+                f"({health.last_error}); retrying in {max(retry_in, 1):.0f}s"
+            )
+        health.trial_started_at = now
+
+@contextlib.contextmanager
+def track(server, operation, size=None):
+    """
+    Time the block as one connect/login/transfer of server and record how
+    it went.
+    """
+    started = time.monotonic()
+    try:
+        yield
+    except NETWORK_ERRORS as e:
+        record_failure(server, operation, e)
+        raise
+    except Exception:
+        record_success(server, operation)
+        raise
+    record_success(server, operation, time.monotonic() - started, size)
+
+def connect_timeout(server):
+    """
+    Timeout for connecting and logging in: a multiple of the host's p95
+    connect/login latency, DEFAULT_TIMEOUT until there are enough samples.
+    """
+    health = get_host_health(server)
+    with health_lock:
+        samples = [health.latencies['connect'], health.latencies['login']]
+        if min(len(latencies) for latencies in samples) < MIN_SAMPLES:
+            return DEFAULT_TIMEOUT
+        slowest = max(percentile(latencies, 0.95) for latencies in samples)
+    return min(DEFAULT_TIMEOUT, max(MIN_CONNECT_TIMEOUT, TIMEOUT_MULTIPLIER * slowest))
+
+def transfer_timeout(server, size=None):
+    """
+    Socket timeout while transferring size bytes: at least DEFAULT_TIMEOUT,
+    more if the host's slow end (p10) throughput would need longer.
+    """
+    health = get_host_health(server)
+    with health_lock:
+        if not size or len(health.throughputs) < MIN_SAMPLES:
+            return DEFAULT_TIMEOUT
+        expected = size / percentile(health.throughputs, 0.10)
+    return min(MAX_TRANSFER_TIMEOUT, max(DEFAULT_TIMEOUT, TIMEOUT_MULTIPLIER * expected))
+
+def health_summary(server):
+    """
+    Snapshot of a host's health for display.
+    """
+    health = get_host_health(server)
+    with health_lock:
+        latencies = {
+            operation: (percentile(samples, 0.5), percentile(samples, 0.95)) if samples else None
+            for operation, samples in health.latencies.items()
+        }
+        throughput = percentile(health.throughputs, 0.5) if health.throughputs else None
+        failures = health.outcomes.count(False)
+        operations = len(health.outcomes)
+        opened_at = health.opened_at
+        last_error = health.last_error
+    return {
+        'latencies': latencies,
+        'throughput': throughput,
+        'failures': failures,
+        'operations': operations,
+        'circuit_open': opened_at is not None,
+        'last_error': last_error,
+        'connect_timeout': connect_timeout(server),
+        'transfer_timeout': transfer_timeout(server),
+    }
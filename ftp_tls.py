@@ -0,0 +1,116 @@
+"""
+FTP_TLS with a shared SSLContext per host and TLS session resumption.
+
+Every protected data connection (STOR, NLST, LIST, ...) is a new TLS
+connection. Plain FTP_TLS handshakes each one from scratch; TunedFTP_TLS
+resumes the control connection's session instead, which saves round trips
+and is required by servers such as vsftpd with require_ssl_reuse. New
+control connections to the same host resume the last session as well.
+"""
+import os
+import ssl
+import time
+import logging
+from ftplib import FTP_TLS
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# OpenSSL cipher string for TLS 1.2 and below, e.g. 'ECDHE+AESGCM'.
+FTP_TLS_CIPHERS = os.environ.get('FTP_TLS_CIPHERS')
+# Comma-separated ALPN protocol ids to offer, e.g. 'ftp'.
+FTP_TLS_ALPN = [protocol for protocol in os.environ.get('FTP_TLS_ALPN', '').split(',') if protocol]
+# '1.2' for servers that can't resume TLS 1.3 sessions on data connections.
+FTP_TLS_MAX_VERSION = os.environ.get('FTP_TLS_MAX_VERSION')
+
+TLS_VERSIONS = {
+    '1.2': ssl.TLSVersion.TLSv1_2,
+    '1.3': ssl.TLSVersion.TLSv1_3,
+}
+
+ssl_contexts = {}
+tls_sessions = {}
+tls_cache_lock = Lock()
+
+def create_ssl_context():
+    """
+    Client context with the same (unverified) certificate handling as the
+    FTP_TLS default, plus the configured ciphers, ALPN and version cap.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    if FTP_TLS_CIPHERS:
+        context.set_ciphers(FTP_TLS_CIPHERS)
+    if FTP_TLS_ALPN:
+        context.set_alpn_protocols(FTP_TLS_ALPN)
+    if FTP_TLS_MAX_VERSION:
+        context.maximum_version = TLS_VERSIONS[FTP_TLS_MAX_VERSION]
+    return context
+
+def get_ssl_context(host):
+    with tls_cache_lock:
+        if host not in ssl_contexts:
+            ssl_contexts[host] = create_ssl_context()
+        return ssl_contexts[host]
+
+class TunedFTP_TLS(FTP_TLS):
+    """
+    FTP_TLS that shares one SSLContext per host, resumes TLS sessions on
+    data and new control connections, and records the handshake time of
+    every data connection in data_handshakes as (seconds, resumed).
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data_handshakes = []
+    
+    def connect(self, host='', port=0, timeout=-999, source_address=None):
+        self.context = get_ssl_context(host or self.host)
+        return super().connect(host, port, timeout, source_address)
+    
+    def auth(self):
+        resp = self.voidcmd('AUTH TLS')
+        with tls_cache_lock:
+            session = tls_sessions.get(self.host)
+        try:
+            self.sock = self.context.wrap_socket(self.sock, server_hostname=self.host, session=session)
+        except ValueError:
+            # Session from an older context (e.g. settings changed)
+            self.sock = self.context.wrap_socket(self.sock, server_hostname=self.host)
+        self.file = self.sock.makefile(mode='r', encoding=self.encoding)
+        return resp
+    
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = super(FTP_TLS, self).ntransfercmd(cmd, rest)
+        if self._prot_p:
+            # With TLS 1.3 the ticket only arrives after the handshake, so
+            # the control session is read here rather than right after AUTH.
+            session = self.sock.session
+            if session is not None:
+                with tls_cache_lock:
+                    tls_sessions[self.host] = session
+            started = time.perf_counter()
+            try:
+                conn = self.context.wrap_socket(conn, server_hostname=self.host, session=session)
+            except Exception:
+                conn.close()
+                raise
+            seconds = time.perf_counter() - started
+            self.data_handshakes.append((seconds, conn.session_reused))
+            logger.info(
+                f"Data channel TLS handshake for {cmd.split()[0]} on {self.host}: {seconds * 1000:.1f} ms "
+                f"({'resumed' if conn.session_reused else 'full'}, {conn.version()})"
+            )
+        return conn, size
+    
+    def handshake_summary(self):
+        """
+        e.g. '3 data TLS handshakes, avg 4.2 ms, 3 resumed'; '' if none.
+        """
+        if not self.data_handshakes:
+            return ''
+        count = len(self.data_handshakes)
+        average = sum(seconds for seconds, _ in self.data_handshakes) / count * 1000
+        resumed = sum(1 for _, reused in self.data_handshakes if reused)
+        return f"{count} data TLS handshakes, avg {average:.1f} ms, {resumed} resumed"
@@ -1,14 +1,29 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import os
 import logging
-import re
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler
-from ftplib import FTP_TLS, error_perm
-import tempfile
-from threading import Thread
-from flask import Flask
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, BasePersistence, BaseRateLimiter, PersistenceInput, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes, ConversationHandler
+from telegram.error import NetworkError, RetryAfter
+from threading import Thread, Lock
 import json
 import traceback
+import shutil
+import contextlib
+import hashlib
+import heapq
+import itertools
+import asyncio
+import uuid
+import argparse
+import re
+import subprocess
+import sys
+
+# Flask, ftplib, sqlite3, tempfile and the cleaning engine (cleaning.py) are
+# imported where they're first used so a cold start only pays for what it
+# needs before the first update.
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -18,50 +33,557 @@ logger = logging.getLogger(__name__)
 
 FTP_HOST, FTP_PORT, FTP_USER, FTP_PASS, FTP_PATH = range(5)
 UPLOAD_FILE = 1
+# Answers collected during /setup. user_data is persisted with the sqlite
+# and redis backends, so they're dropped as soon as setup ends rather than
+# keeping a second copy of the password there.
+SETUP_FIELDS = ('ftp_host', 'ftp_port', 'ftp_user', 'ftp_pass', 'ftp_path')
 
 FTP_CONFIG_FILE = 'ftp_config.json'
 
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "Bot is running!"
-
 def run_flask():
+    from flask import Flask
+    
+    app = Flask(__name__)
+    
+    @app.route('/')
+    def home():
+        return "Bot is running!"
+    
     app.run(host='0.0.0.0', port=8080)
 
-def load_ftp_config(user_id):
-    if not os.path.exists(FTP_CONFIG_FILE):
+# Shared state. The default json backend keeps today's single-process
+# behaviour (configs in ftp_config.json); sqlite shares state between
+# workers on one host, redis (any Redis-compatible server) across hosts.
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'json')
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'bot_state.db')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_KEY_PREFIX = 'ftppullzonebot:'
+# Set to encrypt saved configs (and setup progress) at rest, see
+# config_crypto.py. Needs the cryptography package.
+CONFIG_MASTER_KEY = os.environ.get('CONFIG_MASTER_KEY')
+ENCRYPTED_NAMESPACES = ('config', 'user_data')
+CONFIG_CACHE_SIZE = 1024
+
+PUBLISH_LOCK_TTL = 600
+PUBLISH_LOCK_WAIT = 120
+PUBLISH_LOCK_POLL_INTERVAL = 0.5
+# While a publish runs its lock lease is renewed this often, so a slow
+# upload doesn't outlive PUBLISH_LOCK_TTL and let another one in.
+PUBLISH_LOCK_RENEW_INTERVAL = PUBLISH_LOCK_TTL / 3
+
+class JSONStateBackend:
+    """
+    Single-process backend: configs live in FTP_CONFIG_FILE, everything else
+    (conversation state, locks) in memory. Can't route updates to workers.
+    """
+    
+    def __init__(self, config_file=FTP_CONFIG_FILE):
+        self.config_file = config_file
+        self.namespaces = {}
+        self.locks = {}
+        self.lock = Lock()
+    
+    def read_configs(self):
+        if not os.path.exists(self.config_file):
+            return {}
+        with open(self.config_file, 'r') as f:
+            return json.load(f)
+    
+    def write_configs(self, configs):
+        with open(self.config_file, 'w') as f:
+            json.dump(configs, f, indent=2)
+    
+    def get(self, namespace, key):
+        if namespace == 'config':
+            return self.read_configs().get(key)
+        return self.namespaces.get(namespace, {}).get(key)
+    
+    def set(self, namespace, key, value):
+        with self.lock:
+            if namespace == 'config':
+                configs = {}
+                try:
+                    configs = self.read_configs()
+                except Exception as e:
+                    logger.error(f"Error reading existing config: {e}")
+                configs[key] = value
+                self.write_configs(configs)
+            else:
+                self.namespaces.setdefault(namespace, {})[key] = value
+    
+    def delete(self, namespace, key):
+        with self.lock:
+            if namespace == 'config':
+                configs = self.read_configs()
+                if key not in configs:
+                    return False
+                del configs[key]
+                self.write_configs(configs)
+                return True
+            return self.namespaces.get(namespace, {}).pop(key, None) is not None
+    
+    def items(self, namespace):
+        if namespace == 'config':
+            return list(self.read_configs().items())
+        return list(self.namespaces.get(namespace, {}).items())
+    
+    def acquire_lock(self, name, token, ttl):
+        with self.lock:
+            now = time.time()
+            holder = self.locks.get(name)
+            if holder and holder[1] > now and holder[0] != token:
+                return False
+            self.locks[name] = (token, now + ttl)
+            return True
+    
+    def release_lock(self, name, token):
+        with self.lock:
+            if self.locks.get(name, (None,))[0] == token:
+                del self.locks[name]
+    
+    def push_update(self, partition, payload):
+        raise RuntimeError("The json state backend can't route updates; use sqlite or redis")
+    
+    def pop_updates(self, partition, limit):
+        raise RuntimeError("The json state backend can't route updates; use sqlite or redis")
+
+class SQLiteStateBackend:
+    """
+    Shares state between processes on one host through a SQLite database in
+    WAL mode. Values are stored as JSON.
+    """
+    
+    def __init__(self, path=STATE_DB_PATH):
+        import sqlite3
+        
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS updates ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, partition INTEGER NOT NULL, payload TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS updates_partition ON updates (partition, id)")
+    
+    def get(self, namespace, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set(self, namespace, key, value):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, json.dumps(value))
+            )
+    
+    def delete(self, namespace, key):
+        with self.lock:
+            cursor = self.conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        return cursor.rowcount > 0
+    
+    def items(self, namespace):
+        with self.lock:
+            rows = self.conn.execute("SELECT key, value FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+    
+    def acquire_lock(self, name, token, ttl):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT token, expires FROM locks WHERE name = ?", (name,)).fetchone()
+                if row and row[1] > now and row[0] != token:
+                    self.conn.execute("ROLLBACK")
+                    return False
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO locks (name, token, expires) VALUES (?, ?, ?)", (name, token, now + ttl)
+                )
+                self.conn.execute("COMMIT")
+                return True
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def release_lock(self, name, token):
+        with self.lock:
+            self.conn.execute("DELETE FROM locks WHERE name = ? AND token = ?", (name, token))
+    
+    def push_update(self, partition, payload):
+        with self.lock:
+            self.conn.execute("INSERT INTO updates (partition, payload) VALUES (?, ?)", (partition, payload))
+    
+    def pop_updates(self, partition, limit):
+        with self.lock:
+            rows = self.conn.execute(
+                "DELETE FROM updates WHERE id IN "
+                "(SELECT id FROM updates WHERE partition = ? ORDER BY id LIMIT ?) RETURNING id, payload",
+                (partition, limit)
+            ).fetchall()
+        return [payload for _, payload in sorted(rows)]
+
+class RedisStateBackend:
+    """
+    Shares state across hosts through any Redis-compatible server. Needs the
+    optional redis package.
+    """
+    
+    RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+    )
+    
+    def __init__(self, url=REDIS_URL):
+        import redis
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+    
+    def key(self, *parts):
+        return REDIS_KEY_PREFIX + ':'.join(str(part) for part in parts)
+    
+    def get(self, namespace, key):
+        value = self.client.hget(self.key('kv', namespace), key)
+        return json.loads(value) if value is not None else None
+    
+    def set(self, namespace, key, value):
+        self.client.hset(self.key('kv', namespace), key, json.dumps(value))
+    
+    def delete(self, namespace, key):
+        return self.client.hdel(self.key('kv', namespace), key) > 0
+    
+    def items(self, namespace):
+        return [(key, json.loads(value)) for key, value in self.client.hgetall(self.key('kv', namespace)).items()]
+    
+    def acquire_lock(self, name, token, ttl):
+        lock_key = self.key('lock', name)
+        if self.client.set(lock_key, token, nx=True, px=int(ttl * 1000)):
+            return True
+        # Re-entrant for the current holder: extend the lease.
+        if self.client.get(lock_key) == token:
+            self.client.pexpire(lock_key, int(ttl * 1000))
+            return True
+        return False
+    
+    def release_lock(self, name, token):
+        self.client.eval(self.RELEASE_SCRIPT, 1, self.key('lock', name), token)
+    
+    def push_update(self, partition, payload):
+        self.client.rpush(self.key('updates', partition), payload)
+    
+    def pop_updates(self, partition, limit):
+        updates_key = self.key('updates', partition)
+        with self.client.pipeline(transaction=True) as pipe:
+            pipe.lrange(updates_key, 0, limit - 1)
+            pipe.ltrim(updates_key, limit, -1)
+            payloads, _ = pipe.execute()
+        return payloads
+
+class EncryptedStateBackend:
+    """
+    Wraps another backend and keeps the ENCRYPTED_NAMESPACES encrypted.
+    Up to CONFIG_CACHE_SIZE decrypted records are cached and dropped on set
+    and delete. With a shared backend other workers may save newer records,
+    so a cached one is only used while the stored ciphertext is unchanged.
+    Records saved before encryption was turned on are read as they are and
+    encrypted the next time they're saved (or by encrypt_plaintext).
+    """
+    
+    def __init__(self, backend, cipher, shared):
+        from collections import OrderedDict
+        
+        self.backend = backend
+        self.cipher = cipher
+        self.shared = shared
+        self.cache = OrderedDict()
+        # Bumped on every write, so a read that raced with one isn't cached.
+        self.writes = 0
+        self.lock = Lock()
+    
+    def decrypt(self, namespace, key, record, writes=None):
+        from config_crypto import is_encrypted
+        
+        if not is_encrypted(record):
+            return record
+        cache_key = (namespace, key)
+        with self.lock:
+            cached = self.cache.get(cache_key)
+            if cached and cached[0] == record:
+                self.cache.move_to_end(cache_key)
+                return json.loads(cached[1])
+        
+        plaintext = self.cipher.decrypt_json(namespace, key, record)
+        with self.lock:
+            if writes is not None and writes != self.writes:
+                return json.loads(plaintext)
+            self.cache[cache_key] = (record, plaintext)
+            self.cache.move_to_end(cache_key)
+            while len(self.cache) > CONFIG_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return json.loads(plaintext)
+    
+    def invalidate(self, namespace, key):
+        with self.lock:
+            self.writes += 1
+            self.cache.pop((namespace, key), None)
+    
+    def get(self, namespace, key):
+        if namespace not in ENCRYPTED_NAMESPACES:
+            return self.backend.get(namespace, key)
+        if not self.shared:
+            # Only this process writes, so the cache is authoritative.
+            with self.lock:
+                cached = self.cache.get((namespace, key))
+                if cached:
+                    self.cache.move_to_end((namespace, key))
+                    return json.loads(cached[1])
+                writes = self.writes
+        else:
+            writes = None
+        return self.decrypt(namespace, key, self.backend.get(namespace, key), writes)
+    
+    def set(self, namespace, key, value):
+        if namespace not in ENCRYPTED_NAMESPACES:
+            return self.backend.set(namespace, key, value)
+        self.backend.set(namespace, key, self.cipher.encrypt(namespace, key, value))
+        self.invalidate(namespace, key)
+    
+    def delete(self, namespace, key):
+        if namespace not in ENCRYPTED_NAMESPACES:
+            return self.backend.delete(namespace, key)
+        deleted = self.backend.delete(namespace, key)
+        self.invalidate(namespace, key)
+        return deleted
+    
+    def items(self, namespace):
+        if namespace not in ENCRYPTED_NAMESPACES:
+            return self.backend.items(namespace)
+        with self.lock:
+            writes = self.writes if not self.shared else None
+        return [(key, self.decrypt(namespace, key, record, writes)) for key, record in self.backend.items(namespace)]
+    
+    def encrypt_plaintext(self, namespace):
+        """
+        Encrypt the records of namespace that are still stored in plain
+        text. Returns how many were encrypted.
+        """
+        from config_crypto import is_encrypted
+        
+        count = 0
+        for key, record in self.backend.items(namespace):
+            if not is_encrypted(record):
+                self.set(namespace, key, record)
+                count += 1
+        return count
+    
+    def acquire_lock(self, name, token, ttl):
+        return self.backend.acquire_lock(name, token, ttl)
+    
+    def release_lock(self, name, token):
+        return self.backend.release_lock(name, token)
+    
+    def push_update(self, partition, payload):
+        return self.backend.push_update(partition, payload)
+    
+    def pop_updates(self, partition, limit):
+        return self.backend.pop_updates(partition, limit)
+
+STATE_BACKENDS = {
+    'json': JSONStateBackend,
+    'sqlite': SQLiteStateBackend,
+    'redis': RedisStateBackend,
+}
+
+state_backend = None
+state_backend_lock = Lock()
+
+def get_state_backend():
+    global state_backend
+    with state_backend_lock:
+        if state_backend is None:
+            if STATE_BACKEND not in STATE_BACKENDS:
+                raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND!r}, expected one of {', '.join(STATE_BACKENDS)}")
+            state_backend = STATE_BACKENDS[STATE_BACKEND]()
+            if CONFIG_MASTER_KEY:
+                from config_crypto import ConfigCipher
+                
+                state_backend = EncryptedStateBackend(
+                    state_backend, ConfigCipher(CONFIG_MASTER_KEY), shared=STATE_BACKEND != 'json'
+                )
+            logger.info(f"Using {STATE_BACKEND} state backend{' (encrypted configs)' if CONFIG_MASTER_KEY else ''}")
+        return state_backend
+
+class StatePersistence(BasePersistence):
+    """
+    ConversationHandler state and user_data on the shared state backend, so
+    a user's setup flow survives a restart. The Application writes changes
+    every update_interval seconds and on shutdown; user_data isn't re-read
+    before each update, since a user's updates always go to the same worker
+    and its in-memory copy is the newest one.
+    """
+    
+    def __init__(self, backend):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=1
+        )
+        self.backend = backend
+    
+    async def get_user_data(self):
+        return {int(user_id): data for user_id, data in self.backend.items('user_data')}
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
         return None
     
+    async def get_conversations(self, name):
+        return {
+            tuple(json.loads(key)): state
+            for key, state in self.backend.items(f'conversation:{name}')
+        }
+    
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self.backend.delete(f'conversation:{name}', json.dumps(list(key)))
+        else:
+            self.backend.set(f'conversation:{name}', json.dumps(list(key)), new_state)
+    
+    async def update_user_data(self, user_id, data):
+        self.backend.set('user_data', str(user_id), dict(data))
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def drop_user_data(self, user_id):
+        self.backend.delete('user_data', str(user_id))
+    
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+    
+    async def flush(self):
+        pass
+
+# Publish locks held by this process: token -> task renewing the lease.
+publish_lock_heartbeats = {}
+publish_lock_heartbeats_lock = Lock()
+
+def renew_publish_lock(name, token):
+    # Under the lock, so a renewal can't land after release_publish_lock
+    # has let go of the lock.
+    with publish_lock_heartbeats_lock:
+        if token not in publish_lock_heartbeats:
+            return
+        if not get_state_backend().acquire_lock(name, token, PUBLISH_LOCK_TTL):
+            logger.warning(f"Lost {name} lock before the publish finished")
+
+async def keep_publish_lock(name, token):
+    while True:
+        await asyncio.sleep(PUBLISH_LOCK_RENEW_INTERVAL)
+        try:
+            await asyncio.to_thread(renew_publish_lock, name, token)
+        except Exception as e:
+            logger.error(f"Error renewing {name} lock: {e}")
+
+async def acquire_publish_lock(config, status_msg=None):
+    """
+    Take the per-target publish lock so no two uploads (in this process or
+    on other workers) publish to the same pullzone_hostnames.txt at once.
+    The lease is renewed in the background until release_publish_lock.
+    Returns the lock token to pass to release_publish_lock.
+    """
+    backend = get_state_backend()
+    name = f"publish:{get_target_key(config)}"
+    token = uuid.uuid4().hex
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PUBLISH_LOCK_WAIT
+    notified = False
+    
+    while not await asyncio.to_thread(backend.acquire_lock, name, token, PUBLISH_LOCK_TTL):
+        if loop.time() > deadline:
+            raise RuntimeError("Another upload to this FTP path is still in progress, please try again later")
+        if status_msg and not notified:
+            notified = True
+            try:
+                await status_msg.edit_text(
+                    "⏳ <b>Waiting for another upload to this path to finish...</b>",
+                    parse_mode='HTML'
+                )
+            except Exception as e:
+                logger.info(f"Could not update status message: {e}")
+        await asyncio.sleep(PUBLISH_LOCK_POLL_INTERVAL)
+    
+    with publish_lock_heartbeats_lock:
+        publish_lock_heartbeats[token] = asyncio.create_task(keep_publish_lock(name, token))
+    logger.info(f"Acquired publish lock for {get_target_key(config)}")
+    return token
+
+def release_publish_lock(config, token):
+    with publish_lock_heartbeats_lock:
+        heartbeat = publish_lock_heartbeats.pop(token, None)
+    if heartbeat:
+        # May be called from a worker thread.
+        heartbeat.get_loop().call_soon_threadsafe(heartbeat.cancel)
+    try:
+        get_state_backend().release_lock(f"publish:{get_target_key(config)}", token)
+    except Exception as e:
+        logger.error(f"Error releasing publish lock: {e}")
+
+def load_ftp_config(user_id):
     try:
-        with open(FTP_CONFIG_FILE, 'r') as f:
-            configs = json.load(f)
-            return configs.get(str(user_id))
+        config = get_state_backend().get('config', str(user_id))
+        if isinstance(config, str):
+            logger.error(f"FTP config for user {user_id} is encrypted but CONFIG_MASTER_KEY is not set")
+            return None
+        return config
     except Exception as e:
         logger.error(f"Error loading FTP config: {e}")
         return None
 
 def save_ftp_config(user_id, config):
-    configs = {}
-    if os.path.exists(FTP_CONFIG_FILE):
-        try:
-            with open(FTP_CONFIG_FILE, 'r') as f:
-                configs = json.load(f)
-        except Exception as e:
-            logger.error(f"Error reading existing config: {e}")
-            pass
-    
-    configs[str(user_id)] = config
-    
     try:
-        with open(FTP_CONFIG_FILE, 'w') as f:
-            json.dump(configs, f, indent=2)
+        get_state_backend().set('config', str(user_id), config)
         logger.info(f"FTP config saved for user {user_id}")
     except Exception as e:
         logger.error(f"Error saving FTP config: {e}")
         raise
 
+def delete_ftp_config(user_id):
+    """
+    Returns True if a config was deleted, False if there was none.
+    """
+    deleted = get_state_backend().delete('config', str(user_id))
+    if deleted:
+        logger.info(f"Config deleted for user {user_id}")
+    return deleted
+
 def get_main_menu_keyboard(has_config=False):
     keyboard = [
         [InlineKeyboardButton("⚙️ Setup FTP" if not has_config else "⚙️ Edit FTP Config", callback_data="menu_setup")],
@@ -70,6 +592,7 @@ def get_main_menu_keyboard(has_config=False):
     ]
     if has_config:
         keyboard.append([InlineKeyboardButton("📋 View Saved Config", callback_data="menu_view_config")])
+        keyboard.append([InlineKeyboardButton("📜 Upload History", callback_data="menu_history")])
     keyboard.append([InlineKeyboardButton("ℹ️ Help", callback_data="menu_help")])
     return InlineKeyboardMarkup(keyboard)
 
@@ -81,48 +604,529 @@ def get_cancel_keyboard():
     keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data="cancel_setup")]]
     return InlineKeyboardMarkup(keyboard)
 
-def clean_url_line(line):
+PUBLISHED_STATE_DIR = 'published_state'
+PUBLISH_PATCH_FILES = os.environ.get('PUBLISH_PATCH_FILES', '0') == '1'
+SORT_RUN_LINES = 500_000
+
+def get_target_key(config):
+    """
+    Identify a publish target (server + directory) independent of the user.
+    """
+    return f"{config['host']}:{config['port']}{config['path']}"
+
+def get_published_snapshot_path(config):
+    """
+    Local sorted copy of the hostnames last published to this target.
+    """
+    digest = hashlib.sha1(get_target_key(config).encode('utf-8')).hexdigest()
+    return os.path.join(PUBLISHED_STATE_DIR, f"{digest}.txt")
+
+def sort_hostnames_file(input_path, output_path):
+    """
+    Write the lowercased, deduplicated, sorted hostnames of input_path to
+    output_path. Sorts runs of SORT_RUN_LINES lines in memory and merges the
+    runs from disk, so memory stays bounded on large lists. input_path may
+    be gzip-compressed (.gz), like the files in the upload history.
+    Returns the number of unique hostnames.
+    """
+    import gzip
+    
+    run_paths = []
+    try:
+        with (gzip.open if input_path.endswith('.gz') else open)(input_path, 'rb') as infile:
+            while True:
+                run = {line.strip().lower() for line in itertools.islice(infile, SORT_RUN_LINES)}
+                if not run:
+                    break
+                run.discard(b'')
+                run_path = f"{output_path}.run{len(run_paths)}"
+                with open(run_path, 'wb') as run_file:
+                    run_file.writelines(host + b'\n' for host in sorted(run))
+                run_paths.append(run_path)
+        
+        count = 0
+        run_files = [open(run_path, 'rb') for run_path in run_paths]
+        try:
+            with open(output_path, 'wb') as outfile:
+                previous = None
+                for line in heapq.merge(*run_files):
+                    if line != previous:
+                        outfile.write(line)
+                        count += 1
+                        previous = line
+        finally:
+            for run_file in run_files:
+                run_file.close()
+        return count
+    finally:
+        for run_path in run_paths:
+            if os.path.exists(run_path):
+                os.unlink(run_path)
+
+def diff_sorted_files(old_path, new_path, added_path=None, removed_path=None):
+    """
+    Streaming merge of two sorted hostname files. Optionally writes the
+    added and removed hostnames as patch files.
+    Returns tuple: (added, removed)
+    """
+    added = 0
+    removed = 0
+    with open(old_path, 'rb') as old_file, open(new_path, 'rb') as new_file, \
+            open_patch_file(added_path) as added_file, open_patch_file(removed_path) as removed_file:
+        old_line = old_file.readline()
+        new_line = new_file.readline()
+        while old_line or new_line:
+            if new_line and (not old_line or new_line < old_line):
+                added += 1
+                if added_file:
+                    added_file.write(new_line)
+                new_line = new_file.readline()
+            elif old_line and (not new_line or old_line < new_line):
+                removed += 1
+                if removed_file:
+                    removed_file.write(old_line)
+                old_line = old_file.readline()
+            else:
+                old_line = old_file.readline()
+                new_line = new_file.readline()
+    return added, removed
+
+def open_patch_file(path):
+    """
+    Open a patch file for writing, or a null context if not wanted.
+    """
+    if path:
+        return open(path, 'wb')
+    return contextlib.nullcontext()
+
+def compute_publish_diff(config, cleaned_path, write_patches=False, work_path=None):
     """
-    Clean a line by removing http://, https://, www., and trailing paths/slashes.
-    Returns just the hostname.
+    Compare a cleaned file with the last list published to the same target.
+    Returns a dict with the added/removed counts, whether this is the first
+    publish, the new sorted snapshot (to commit after a successful publish)
+    and, if requested, the paths of the added/removed patch files. Those
+    files are named after work_path (default: cleaned_path).
     """
-    line = line.strip()
-    if not line:
-        return line
+    work_path = work_path or cleaned_path
+    snapshot_path = work_path + '.sorted'
+    total = sort_hostnames_file(cleaned_path, snapshot_path)
+    
+    diff = {
+        'total': total,
+        'added': total,
+        'removed': 0,
+        'first': True,
+        'snapshot_path': snapshot_path,
+        'added_path': None,
+        'removed_path': None,
+    }
+    
+    published_path = get_published_snapshot_path(config)
+    if not os.path.exists(published_path):
+        return diff
     
-    line = re.sub(r'^https?://', '', line, flags=re.IGNORECASE)
-    line = re.sub(r'^www\.', '', line, flags=re.IGNORECASE)
-    line = re.sub(r'/.*$', '', line)
-    line = line.strip()
+    if write_patches:
+        diff['added_path'] = work_path + '.added'
+        diff['removed_path'] = work_path + '.removed'
     
-    return line
+    diff['added'], diff['removed'] = diff_sorted_files(
+        published_path, snapshot_path, diff['added_path'], diff['removed_path']
+    )
+    diff['first'] = False
+    return diff
+
+def commit_published_snapshot(config, snapshot_path):
+    """
+    Record snapshot_path as the list now published to this target.
+    """
+    os.makedirs(PUBLISHED_STATE_DIR, exist_ok=True)
+    shutil.move(snapshot_path, get_published_snapshot_path(config))
+    logger.info(f"Recorded published snapshot for {get_target_key(config)}")
+
+def format_publish_diff(diff):
+    """
+    One-line summary of a publish diff for status messages.
+    """
+    if diff['first']:
+        return f"📊 {diff['total']:,} hostnames (first publish to this target)"
+    if not diff['added'] and not diff['removed']:
+        return f"📊 No changes since last publish ({diff['total']:,} hostnames)"
+    return f"📊 Changes since last publish: +{diff['added']:,} / -{diff['removed']:,}"
+
+# Upload history: every published file is kept gzip-compressed under
+# HISTORY_DIR, named by its SHA-256, so the same list published twice (or to
+# several targets) is stored once. Each user/target pair has a small JSON
+# index of its uploads, newest first. Objects are evicted least recently
+# used first once the archive grows past HISTORY_MAX_MB.
+HISTORY_DIR = 'upload_history'
+HISTORY_MAX_BYTES = int(os.environ.get('HISTORY_MAX_MB', '200')) * 1024 * 1024
+HISTORY_MAX_ENTRIES = 10
+HISTORY_COMPRESS_LEVEL = 6
+HISTORY_BLOCK_BYTES = 1024 * 1024
 
-def process_file_content(input_path, output_path):
+def get_history_index_path(user_id, config):
+    digest = hashlib.sha1(f"{user_id}|{get_target_key(config)}".encode('utf-8')).hexdigest()
+    return os.path.join(HISTORY_DIR, 'index', f"{digest}.json")
+
+def get_history_object_path(sha256):
+    return os.path.join(HISTORY_DIR, 'objects', sha256[:2], f"{sha256}.gz")
+
+def load_history(user_id, config):
+    """
+    The user's uploads to this target, newest first.
+    """
+    path = get_history_index_path(user_id, config)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_history(user_id, config, entries):
+    path = get_history_index_path(user_id, config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(entries, f, indent=2)
+    os.replace(tmp_path, path)
+
+def store_history_object(path):
     """
-    Process file to clean URLs - remove http://, https://, www., and paths.
-    Returns tuple: (lines_processed, lines_cleaned)
+    Add the contents of path to the archive unless they're already there
+    (then only its LRU time is refreshed). Returns the SHA-256.
     """
-    lines_processed = 0
-    lines_cleaned = 0
+    import gzip
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HISTORY_BLOCK_BYTES), b''):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+    
+    object_path = get_history_object_path(sha256)
+    if os.path.exists(object_path):
+        os.utime(object_path)
+        return sha256
     
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    tmp_path = f"{object_path}.{uuid.uuid4().hex[:8]}.tmp"
     try:
-        with open(input_path, 'r', encoding='utf-8', errors='ignore') as infile:
-            with open(output_path, 'w', encoding='utf-8') as outfile:
-                for line in infile:
-                    lines_processed += 1
-                    original = line.strip()
-                    cleaned = clean_url_line(original)
-                    
-                    if cleaned and cleaned != original:
-                        lines_cleaned += 1
-                    
-                    if cleaned:
-                        outfile.write(cleaned + '\n')
-        
-        return lines_processed, lines_cleaned
-    except Exception as e:
-        logger.error(f"Error processing file content: {e}")
-        raise
+        with open(path, 'rb') as infile, \
+                gzip.open(tmp_path, 'wb', compresslevel=HISTORY_COMPRESS_LEVEL) as outfile:
+            shutil.copyfileobj(infile, outfile, HISTORY_BLOCK_BYTES)
+        os.replace(tmp_path, object_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return sha256
+
+def evict_history_objects(keep=None):
+    """
+    Delete the least recently used archived files until the archive fits in
+    HISTORY_MAX_BYTES. The object with SHA-256 keep is never deleted.
+    """
+    objects = []
+    for directory, _, names in os.walk(os.path.join(HISTORY_DIR, 'objects')):
+        for name in names:
+            if name.endswith('.gz'):
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                objects.append((stat.st_mtime, stat.st_size, path))
+    
+    total = sum(size for _, size, _ in objects)
+    keep_path = get_history_object_path(keep) if keep else None
+    for _, size, path in sorted(objects):
+        if total <= HISTORY_MAX_BYTES:
+            break
+        if path == keep_path:
+            continue
+        os.unlink(path)
+        total -= size
+        logger.info(f"Evicted {os.path.basename(path)} from the upload history")
+
+def add_history_entry(user_id, config, sha256, file_name, size, publish_diff=None, republished_from=None):
+    """
+    Put an upload at the top of the user's history for this target.
+    Returns the new entry.
+    """
+    entry = {
+        'id': uuid.uuid4().hex[:10],
+        'sha256': sha256,
+        'file_name': file_name,
+        'size': size,
+        'hostnames': publish_diff['total'] if publish_diff else None,
+        'added': publish_diff['added'] if publish_diff and not publish_diff['first'] else None,
+        'removed': publish_diff['removed'] if publish_diff and not publish_diff['first'] else None,
+        'published_at': time.time(),
+        'republished_from': republished_from,
+    }
+    entries = [entry] + load_history(user_id, config)
+    save_history(user_id, config, entries[:HISTORY_MAX_ENTRIES])
+    return entry
+
+def archive_upload(user_id, config, path, file_name, publish_diff=None):
+    """
+    Keep the file just published from path in the archive and record it in
+    the user's history. Blocking. Returns the new entry.
+    """
+    started = time.perf_counter()
+    sha256 = store_history_object(path)
+    entry = add_history_entry(user_id, config, sha256, file_name, os.path.getsize(path), publish_diff)
+    evict_history_objects(keep=sha256)
+    logger.info(f"Archived {file_name} as {sha256[:12]} in {time.perf_counter() - started:.2f}s")
+    return entry
+
+def find_history_entry(user_id, config, entry_id):
+    """
+    Returns (entry, archived file path), or (None, None) if the entry is
+    unknown or its file was evicted.
+    """
+    for entry in load_history(user_id, config):
+        if entry['id'] == entry_id:
+            object_path = get_history_object_path(entry['sha256'])
+            if not os.path.exists(object_path):
+                return None, None
+            return entry, object_path
+    return None, None
+
+# Outbound Bot API throttling. Telegram allows roughly 30 messages/s per bot,
+# about one per second in a private chat and 20 per minute in a group; edits
+# count towards the same limits.
+# Bucket rate + burst is chosen so no rolling one-second window exceeds the
+# documented limit.
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '25'))
+TELEGRAM_GLOBAL_BURST = 5
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_GROUP_RATE = 20 / 60
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_RETRIES = 3
+# Progress edits that can't go out within this many seconds are skipped
+# rather than holding up the upload; the next edit shows newer state anyway.
+TELEGRAM_PROGRESS_MAX_DELAY = 0.5
+# Longest a blocking FTP step waits for its status edit to go out.
+PROGRESS_EDIT_TIMEOUT = 5
+
+PRIORITY_URGENT, PRIORITY_FINAL, PRIORITY_PROGRESS = range(3)
+
+class TokenBucket:
+    """
+    Classic token bucket: rate tokens per second, up to capacity.
+    """
+    
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+    
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now):
+        """
+        Seconds until a token is available (0 if one is available now).
+        """
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def consume(self):
+        self.tokens -= 1
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    Outbound request scheduler for the Application's bot.
+    
+    Every request waits for a token from a global bucket and from its chat's
+    bucket (requests without a chat, such as callback answers and getFile,
+    only from the global one). Queued requests are dispatched by priority:
+    callback answers first, then everything else, then intermediate progress
+    edits (sent with rate_limit_args={'progress': True}, see
+    edit_progress). Only those may be skipped: a progress edit is dropped
+    when a newer edit for the same message arrives or when it can't be sent
+    within TELEGRAM_PROGRESS_MAX_DELAY, so throttling never slows an upload
+    down. RetryAfter pauses all dispatching for the requested time and retries.
+    """
+    
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, max_retries=TELEGRAM_MAX_RETRIES,
+                 progress_max_delay=TELEGRAM_PROGRESS_MAX_DELAY, global_burst=TELEGRAM_GLOBAL_BURST):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.progress_max_delay = progress_max_delay
+        self.global_bucket = None
+        self.chat_buckets = {}
+        self.queue = []
+        self.queued_progress = {}
+        self.sequence = itertools.count()
+        self.paused_until = 0.0
+        self.wakeup = None
+        self.dispatcher = None
+        self.stats = {'sent': 0, 'skipped': 0, 'retry_after': 0}
+    
+    async def initialize(self):
+        loop = asyncio.get_running_loop()
+        self.global_bucket = TokenBucket(self.global_rate, self.global_burst, loop.time())
+        self.wakeup = asyncio.Event()
+        self.dispatcher = asyncio.create_task(self.dispatch_loop())
+    
+    async def shutdown(self):
+        if self.dispatcher:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher = None
+        for entry in self.queue:
+            if not entry[2]['future'].done():
+                entry[2]['future'].cancel()
+        self.queue.clear()
+        self.queued_progress.clear()
+    
+    @staticmethod
+    def request_priority(endpoint, rate_limit_args):
+        if endpoint == 'answerCallbackQuery':
+            return PRIORITY_URGENT
+        if endpoint == 'editMessageText' and rate_limit_args and rate_limit_args.get('progress'):
+            return PRIORITY_PROGRESS
+        return PRIORITY_FINAL
+    
+    def chat_delay(self, chat_id, now):
+        """
+        Seconds until chat_id's bucket has a token; 0 for requests without a
+        chat, which only count towards the global limit.
+        """
+        if chat_id is None:
+            return 0.0
+        return self.get_chat_bucket(chat_id, now).delay(now)
+    
+    def get_chat_bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                # Drop buckets of idle chats; they'd be full again anyway.
+                for idle_chat in [c for c, b in self.chat_buckets.items() if now - b.updated > 60]:
+                    del self.chat_buckets[idle_chat]
+            rate = TELEGRAM_GROUP_RATE if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = TokenBucket(rate, self.chat_burst, now)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+    
+    async def acquire(self, priority, chat_id, progress_key):
+        """
+        Queue a request and wait for its turn.
+        Returns False when it may be sent, True when it should be skipped.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        request = {'chat_id': chat_id, 'future': loop.create_future(), 'deadline': None}
+        
+        if priority == PRIORITY_PROGRESS:
+            if now + self.progress_max_delay < self.paused_until or \
+                    self.chat_delay(chat_id, now) > self.progress_max_delay:
+                return True
+            request['deadline'] = now + self.progress_max_delay
+        
+        if progress_key is not None:
+            previous = self.queued_progress.pop(progress_key, None)
+            if previous and not previous['future'].done():
+                previous['future'].set_result(True)
+            if priority == PRIORITY_PROGRESS:
+                self.queued_progress[progress_key] = request
+        
+        heapq.heappush(self.queue, (priority, next(self.sequence), request))
+        self.wakeup.set()
+        try:
+            return await request['future']
+        finally:
+            if progress_key is not None and self.queued_progress.get(progress_key) is request:
+                del self.queued_progress[progress_key]
+    
+    async def dispatch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            now = loop.time()
+            delay = None
+            
+            # Drop progress edits past their deadline, and requests that were
+            # superseded or cancelled while queued.
+            for entry in self.queue:
+                request = entry[2]
+                if request['deadline'] is not None and request['deadline'] < now and not request['future'].done():
+                    request['future'].set_result(True)
+            if any(entry[2]['future'].done() for entry in self.queue):
+                self.queue = [entry for entry in self.queue if not entry[2]['future'].done()]
+                heapq.heapify(self.queue)
+            
+            if self.queue:
+                delay = max(self.paused_until - now, self.global_bucket.delay(now))
+                if delay <= 0:
+                    delay = None
+                    for entry in sorted(self.queue):
+                        chat_id = entry[2]['chat_id']
+                        chat_delay = self.chat_delay(chat_id, now)
+                        if chat_delay <= 0:
+                            if chat_id is not None:
+                                self.get_chat_bucket(chat_id, now).consume()
+                            self.global_bucket.consume()
+                            self.queue.remove(entry)
+                            heapq.heapify(self.queue)
+                            entry[2]['future'].set_result(False)
+                            delay = 0
+                            break
+                        delay = chat_delay if delay is None else min(delay, chat_delay)
+            
+            if delay == 0:
+                await asyncio.sleep(0)
+                continue
+            
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = self.request_priority(endpoint, rate_limit_args)
+        chat_id = data.get('chat_id')
+        progress_key = None
+        if endpoint == 'editMessageText' and data.get('message_id') is not None:
+            progress_key = (chat_id, data['message_id'])
+        
+        for attempt in range(self.max_retries + 1):
+            if await self.acquire(priority, chat_id, progress_key):
+                self.stats['skipped'] += 1
+                return True
+            
+            try:
+                result = await callback(*args, **kwargs)
+                self.stats['sent'] += 1
+                return result
+            except RetryAfter as exc:
+                self.stats['retry_after'] += 1
+                if attempt == self.max_retries:
+                    raise
+                loop = asyncio.get_running_loop()
+                self.paused_until = max(self.paused_until, loop.time() + exc.retry_after + 0.1)
+                logger.info(f"Telegram rate limit hit on {endpoint}, pausing for {exc.retry_after}s")
+                self.wakeup.set()
+
+async def edit_progress(bot, message, text):
+    """
+    Edit a status message with intermediate progress. The rate limiter may
+    skip such edits under load; anything the user must see goes through a
+    normal edit instead.
+    """
+    await bot.edit_message_text(
+        text,
+        chat_id=message.chat_id,
+        message_id=message.message_id,
+        parse_mode='HTML',
+        rate_limit_args={'progress': True}
+    )
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -167,6 +1171,8 @@ async def show_help(query_or_update, is_callback=False):
         "   • Upload to your FTP server\n\n"
         "<b>3️⃣ Test Connection:</b>\n"
         "Verify your FTP credentials are working\n\n"
+        "<b>📜 Upload History:</b>\n"
+        "See your recent uploads and republish an older version in one tap (/history)\n\n"
         "<b>🔒 Security:</b>\n"
         "All connections use TLS encryption for security."
     )
@@ -212,6 +1218,10 @@ async def setup_start(query_or_update, context: ContextTypes.DEFAULT_TYPE, is_ca
         logger.error(f"Error in setup_start: {e}")
         return ConversationHandler.END
 
+def clear_setup_fields(user_data):
+    for field in SETUP_FIELDS:
+        user_data.pop(field, None)
+
 async def ftp_host(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         host = update.message.text.strip()
@@ -346,6 +1356,7 @@ async def ftp_path(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'pass': context.user_data['ftp_pass'],
             'path': context.user_data['ftp_path']
         }
+        clear_setup_fields(context.user_data)
         
         await update.message.reply_text("💾 Saving configuration...")
         
@@ -373,6 +1384,7 @@ async def ftp_path(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error in ftp_path: {e}\n{traceback.format_exc()}")
+        clear_setup_fields(context.user_data)
         await update.message.reply_text(
             f"❌ An unexpected error occurred: {str(e)}\n\n"
             "Please try again or contact support."
@@ -380,6 +1392,7 @@ async def ftp_path(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 async def setup_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_setup_fields(context.user_data)
     try:
         await update.message.reply_text(
             "❌ FTP setup cancelled.",
@@ -390,6 +1403,9 @@ async def setup_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def test_connection(query_or_update, user_id, is_callback=False):
+    from ftplib import error_perm
+    from ftp_health import HostUnavailable
+    
     config = load_ftp_config(user_id)
     
     if not config:
@@ -433,23 +1449,23 @@ async def test_connection(query_or_update, user_id, is_callback=False):
     
     ftp = None
     try:
-        ftp = FTP_TLS(timeout=30)
-        ftp.connect(config['host'], config['port'])
-        ftp.login(config['user'], config['pass'])
-        ftp.prot_p()
-        ftp.cwd(config['path'])
+        ftp = await asyncio.to_thread(open_ftp_session, config)
         
         files = []
-        ftp.retrlines('LIST', files.append)
+        await asyncio.to_thread(ftp.retrlines, 'LIST', files.append)
         
         pullzone_exists = any('pullzone_hostnames.txt' in f for f in files)
         
+        handshake_seconds, resumed = ftp.data_handshakes[-1]
         success_msg = (
             f"✅ <b>Connection Successful!</b>\n\n"
             f"📡 Host: <code>{config['host']}:{config['port']}</code>\n"
             f"📂 Path: <code>{config['path']}</code>\n"
             f"📄 Files in directory: {len(files)}\n"
-            f"🎯 pullzone_hostnames.txt: {'✅ Found' if pullzone_exists else '❌ Not found'}"
+            f"🎯 pullzone_hostnames.txt: {'✅ Found' if pullzone_exists else '❌ Not found'}\n"
+            f"🔐 TLS: {ftp.sock.version()}, data channel handshake {handshake_seconds * 1000:.0f} ms "
+            f"({'session resumed' if resumed else 'full handshake'})\n\n"
+            f"{format_host_health(config)}"
         )
         
         await message.edit_text(
@@ -471,6 +1487,17 @@ async def test_connection(query_or_update, user_id, is_callback=False):
             parse_mode='HTML',
             reply_markup=get_back_to_menu_keyboard()
         )
+    except HostUnavailable as e:
+        error_msg = (
+            f"⛔ <b>FTP Server Marked Down</b>\n\n"
+            f"{str(e)}\n\n"
+            f"{format_host_health(config)}"
+        )
+        await message.edit_text(
+            error_msg,
+            parse_mode='HTML',
+            reply_markup=get_back_to_menu_keyboard()
+        )
     except TimeoutError:
         error_msg = (
             f"❌ <b>Connection Timeout</b>\n\n"
@@ -478,7 +1505,8 @@ async def test_connection(query_or_update, user_id, is_callback=False):
             f"Please check:\n"
             f"• Host is correct\n"
             f"• Port is correct\n"
-            f"• Server is online"
+            f"• Server is online\n\n"
+            f"{format_host_health(config)}"
         )
         await message.edit_text(
             error_msg,
@@ -490,7 +1518,8 @@ async def test_connection(query_or_update, user_id, is_callback=False):
         error_msg = (
             f"❌ <b>Connection Failed</b>\n\n"
             f"Error: <code>{str(e)}</code>\n\n"
-            f"Please verify your FTP credentials."
+            f"Please verify your FTP credentials.\n\n"
+            f"{format_host_health(config)}"
         )
         await message.edit_text(
             error_msg,
@@ -499,25 +1528,722 @@ async def test_connection(query_or_update, user_id, is_callback=False):
         )
     finally:
         if ftp:
-            try:
-                ftp.quit()
-            except:
-                try:
-                    ftp.close()
-                except:
-                    pass
+            await asyncio.to_thread(close_ftp_session, ftp)
 
-async def upload_start(query_or_update, context: ContextTypes.DEFAULT_TYPE, is_callback=False):
-    user_id = query_or_update.from_user.id if is_callback else query_or_update.effective_user.id
-    config = load_ftp_config(user_id)
+def format_host_health(config):
+    """
+    Multi-line summary of the latencies, errors, timeouts and circuit state
+    tracked for the config's host.
+    """
+    from ftp_health import health_summary
     
-    if not config:
-        error_msg = (
-            "❌ <b>No FTP Configuration Found</b>\n\n"
-            "Please setup your FTP credentials first."
-        )
-        try:
-            if is_callback:
+    health = health_summary(f"{config['host']}:{config['port']}")
+    text = f"🩺 <b>Host health</b> (last {health['operations']} operations, {health['failures']} failed)\n"
+    for operation in ('connect', 'login'):
+        if health['latencies'][operation]:
+            p50, p95 = health['latencies'][operation]
+            text += f"   {operation.capitalize()}: {p50 * 1000:.0f} ms (p95 {p95 * 1000:.0f} ms)\n"
+    if health['throughput']:
+        text += f"   Upload: {health['throughput'] / (1024 * 1024):.1f} MB/s\n"
+    text += (
+        f"   Timeouts: connect {health['connect_timeout']:.0f}s, transfer {health['transfer_timeout']:.0f}s\n"
+    )
+    if health['circuit_open']:
+        text += f"   Circuit: ⛔ open, failing fast (<code>{health['last_error']}</code>)"
+    else:
+        text += "   Circuit: ✅ closed"
+    return text
+
+# Speculative FTP connection: while the user picks a file after /upload, a
+# session is opened, logged in and moved to the target directory in the
+# background so upload_file can skip the connect round trips.
+PREWARM_FTP = os.environ.get('PREWARM_FTP', '1') != '0'
+# Pre-warmed sessions nobody picks up within this many seconds are closed
+# (well under the idle timeout of most FTP servers).
+PREWARM_FTP_TIMEOUT = 120
+# Sessions younger than this are used without a NOOP liveness check.
+PREWARM_FTP_FRESH = 15
+
+prewarmed_ftp_sessions = {}
+
+def open_ftp_session(config, track_health=True):
+    """
+    Connect, log in, protect the data channel and change to the target
+    directory, with timeouts adapted to the host (see ftp_health.py).
+    Blocking; returns the FTP_TLS session. Raises HostUnavailable at once
+    while the host's circuit is open. With track_health=False the attempt
+    isn't recorded, for extra upload sessions that a server limiting
+    connections per user may turn away with 421.
+    """
+    from ftp_tls import TunedFTP_TLS
+    from ftp_health import check_circuit, connect_timeout, track, transfer_timeout
+    
+    server = f"{config['host']}:{config['port']}"
+    
+    def tracked(operation):
+        return track(server, operation) if track_health else contextlib.nullcontext()
+    
+    check_circuit(server)
+    ftp = TunedFTP_TLS(timeout=connect_timeout(server))
+    try:
+        with tracked('connect'):
+            ftp.connect(config['host'], config['port'])
+        with tracked('login'):
+            ftp.login(config['user'], config['pass'])
+            ftp.prot_p()
+            ftp.cwd(config['path'])
+        set_ftp_timeout(ftp, transfer_timeout(server))
+    except Exception:
+        close_ftp_session(ftp)
+        raise
+    return ftp
+
+def set_ftp_timeout(ftp, seconds):
+    """
+    Timeout for the control connection and new data connections.
+    """
+    ftp.timeout = seconds
+    ftp.sock.settimeout(seconds)
+
+def close_ftp_session(ftp):
+    """
+    QUIT, falling back to just closing the socket. The control connection
+    may still have a long transfer timeout set; QUIT only needs a round
+    trip, so it gets the host's connect timeout instead. Blocking.
+    """
+    from ftp_health import connect_timeout
+    
+    try:
+        set_ftp_timeout(ftp, connect_timeout(f"{ftp.host}:{ftp.port}"))
+        ftp.quit()
+    except:
+        try:
+            ftp.close()
+        except:
+            pass
+
+def close_ftp_session_when_ready(task):
+    """
+    Close the session a pre-connect task produces, without blocking the
+    event loop, whether or not it has finished connecting yet.
+    """
+    def on_done(task):
+        if not task.cancelled() and not task.exception():
+            asyncio.get_running_loop().run_in_executor(None, close_ftp_session, task.result())
+    
+    task.add_done_callback(on_done)
+
+def start_ftp_prewarm(user_id, config):
+    if not PREWARM_FTP:
+        return
+    discard_ftp_prewarm(user_id)
+    loop = asyncio.get_running_loop()
+    task = asyncio.create_task(asyncio.to_thread(open_ftp_session, config))
+    timer = loop.call_later(PREWARM_FTP_TIMEOUT, discard_ftp_prewarm, user_id)
+    prewarmed_ftp_sessions[user_id] = (task, timer, dict(config), loop.time())
+    logger.info(f"Pre-connecting to FTP for user {user_id}")
+
+def discard_ftp_prewarm(user_id):
+    entry = prewarmed_ftp_sessions.pop(user_id, None)
+    if not entry:
+        return
+    task, timer, _, _ = entry
+    timer.cancel()
+    close_ftp_session_when_ready(task)
+    logger.info(f"Closed pre-warmed FTP session for user {user_id}")
+
+async def take_prewarmed_ftp(user_id, config):
+    """
+    Hand over the user's pre-warmed session if it was opened for this exact
+    config and is still alive; returns None otherwise.
+    """
+    entry = prewarmed_ftp_sessions.pop(user_id, None)
+    if not entry:
+        return None
+    task, timer, prewarm_config, opened = entry
+    timer.cancel()
+    if prewarm_config != config:
+        close_ftp_session_when_ready(task)
+        return None
+    
+    try:
+        ftp = await task
+    except Exception as e:
+        logger.info(f"Pre-warmed FTP connection failed, connecting again: {e}")
+        return None
+    
+    if asyncio.get_running_loop().time() - opened < PREWARM_FTP_FRESH:
+        return ftp
+    try:
+        await asyncio.to_thread(ftp.voidcmd, 'NOOP')
+    except Exception as e:
+        logger.info(f"Pre-warmed FTP session went stale, connecting again: {e}")
+        await asyncio.to_thread(close_ftp_session, ftp)
+        return None
+    return ftp
+
+# Multi-stream upload: large files are split into byte ranges sent over
+# several FTP sessions at once, each writing its range into the same remote
+# file with REST + STOR. Only for servers that accept REST past the current
+# end of file (e.g. vsftpd); others refuse the REST and the upload falls
+# back to a single STOR.
+FTP_UPLOAD_STREAMS = int(os.environ.get('FTP_UPLOAD_STREAMS', '1'))
+MULTI_STREAM_MIN_PART_BYTES = 4 * 1024 * 1024
+UPLOAD_BLOCK_BYTES = 64 * 1024
+
+# host:port of servers that refused extra sessions or a ranged STOR; they
+# get single uploads.
+single_stream_hosts = set()
+
+class MultiStreamUnavailable(Exception):
+    """
+    The server wouldn't take the extra upload sessions or a ranged STOR.
+    """
+
+# Uploads are checked on the server before they go live: SIZE, plus the
+# checksum the server offers (HASH, XMD5 or XCRC) against one computed while
+# the file was streamed, so nothing is downloaded again. A mismatch uploads
+# the file again, up to PUBLISH_VERIFY_RETRIES times.
+VERIFY_PUBLISH = os.environ.get('VERIFY_PUBLISH', '1') != '0'
+PUBLISH_VERIFY_RETRIES = 2
+# FTP HASH algorithm names (RFC draft-bryan-ftpext-hash) to hashlib names.
+CHECKSUM_ALGORITHMS = {
+    'SHA-256': 'sha256',
+    'SHA-512': 'sha512',
+    'SHA-1': 'sha1',
+    'MD5': 'md5',
+    'CRC32': 'crc32',
+}
+
+# host:port -> (command, algorithm) from the server's FEAT reply.
+checksum_commands = {}
+
+class Crc32:
+    """
+    zlib.crc32 with the hashlib update/hexdigest interface.
+    """
+    
+    def __init__(self):
+        import zlib
+        
+        self.crc32 = zlib.crc32
+        self.value = 0
+    
+    def update(self, data):
+        self.value = self.crc32(data, self.value)
+    
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+class UploadDigest:
+    """
+    Size and checksum of an upload, computed from the blocks as they are
+    sent (update is a storbinary callback).
+    """
+    
+    def __init__(self, algorithm=None):
+        self.algorithm = algorithm
+        self.reset()
+    
+    def reset(self):
+        self.size = 0
+        self.checksum = None
+        if self.algorithm == 'CRC32':
+            self.checksum = Crc32()
+        elif self.algorithm:
+            self.checksum = hashlib.new(CHECKSUM_ALGORITHMS[self.algorithm])
+    
+    def update(self, block):
+        self.size += len(block)
+        if self.checksum:
+            self.checksum.update(block)
+    
+    def update_from_file(self, path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(UPLOAD_BLOCK_BYTES), b''):
+                self.update(block)
+    
+    def hexdigest(self):
+        return self.checksum.hexdigest() if self.checksum else None
+
+def get_checksum_command(ftp, config):
+    """
+    (command, algorithm) the server can checksum a stored file with: HASH
+    with its currently selected algorithm, else XMD5, else XCRC, as
+    advertised in FEAT; (None, None) if none. Cached per server.
+    """
+    from ftplib import Error
+    
+    server = f"{config['host']}:{config['port']}"
+    if server in checksum_commands:
+        return checksum_commands[server]
+    
+    try:
+        features = [line.strip().upper() for line in ftp.sendcmd('FEAT').splitlines()[1:-1]]
+    except Error:
+        features = []
+    
+    command = (None, None)
+    for feature in features:
+        name, _, algorithms = feature.partition(' ')
+        if name == 'HASH':
+            for algorithm in algorithms.split(';'):
+                if algorithm.endswith('*') and algorithm[:-1] in CHECKSUM_ALGORITHMS:
+                    command = ('HASH', algorithm[:-1])
+    if not command[0]:
+        if 'XMD5' in features:
+            command = ('XMD5', 'MD5')
+        elif 'XCRC' in features:
+            command = ('XCRC', 'CRC32')
+    
+    checksum_commands[server] = command
+    logger.info(f"Checksum command for {server}: {command[0] and ' '.join(command) or 'none'}")
+    return command
+
+def get_remote_checksum(ftp, config, remote_name, command):
+    """
+    Ask the server for the checksum of remote_name. Returns the lowercase
+    hex digest, or None if the server turned out not to support it.
+    """
+    from ftplib import Error
+    
+    try:
+        resp = ftp.sendcmd(f'{command} {remote_name}')
+    except Error as e:
+        checksum_commands[f"{config['host']}:{config['port']}"] = (None, None)
+        logger.info(f"{command} failed on {config['host']}, verifying by size only: {e}")
+        return None
+    
+    # HASH: '213 SHA-256 0-49 <hash> <name>'; XMD5/XCRC: '250 <hash>'
+    tokens = resp.split()
+    checksum = tokens[3] if command == 'HASH' and len(tokens) > 3 else tokens[-1]
+    checksum = checksum.strip('"').lower()
+    if command == 'XCRC':
+        try:
+            checksum = f"{int(checksum, 16):08x}"
+        except ValueError:
+            pass
+    return checksum
+
+def get_remote_mtime(ftp, remote_name):
+    """
+    MDTM of remote_name as 'YYYY-MM-DD HH:MM:SS UTC', or None.
+    """
+    from ftplib import Error
+    
+    try:
+        value = ftp.sendcmd(f'MDTM {remote_name}').split()[-1]
+    except Error:
+        return None
+    if len(value) < 14 or not value[:14].isdigit():
+        return None
+    return f"{value[:4]}-{value[4:6]}-{value[6:8]} {value[8:10]}:{value[10:12]}:{value[12:14]} UTC"
+
+def verify_upload(ftp, config, remote_name, digest):
+    """
+    Compare the server's SIZE (and checksum, if digest has one) of
+    remote_name with digest, right after the upload while the session is
+    still in binary mode. Blocking. Returns dict with ok, size,
+    remote_size, algorithm, checksum, remote_checksum and modified.
+    """
+    from ftplib import Error
+    
+    try:
+        remote_size = ftp.size(remote_name)
+    except Error as e:
+        logger.info(f"SIZE failed for {remote_name}: {e}")
+        remote_size = None
+    
+    command, _ = get_checksum_command(ftp, config)
+    remote_checksum = None
+    if digest.algorithm and command and remote_size in (None, digest.size):
+        remote_checksum = get_remote_checksum(ftp, config, remote_name, command)
+    
+    # A server without SIZE only fails verification on a checksum mismatch.
+    verification = {
+        'ok': remote_size in (None, digest.size) and remote_checksum in (None, digest.hexdigest()),
+        'size': digest.size,
+        'remote_size': remote_size,
+        'algorithm': digest.algorithm if remote_checksum else None,
+        'checksum': digest.hexdigest(),
+        'remote_checksum': remote_checksum,
+        'modified': get_remote_mtime(ftp, remote_name),
+    }
+    logger.info(
+        f"Verified {remote_name}: size {remote_size}/{digest.size}, "
+        f"{verification['algorithm'] or 'no checksum'} "
+        f"{'match' if verification['ok'] else 'MISMATCH'}, modified {verification['modified']}"
+    )
+    return verification
+
+def format_verification(verification):
+    """
+    One-line summary of a server-side check for status messages.
+    """
+    checks = [name for name, done in (
+        ('size', verification['remote_size'] is not None),
+        (verification['algorithm'], verification['algorithm']),
+    ) if done]
+    if not checks:
+        return "🔍 Server supports no SIZE or checksum, upload not verified"
+    text = f"🔍 Verified on server: {' + '.join(checks)}"
+    if verification['modified']:
+        text += f", modified {verification['modified']}"
+    if verification['attempts'] > 1:
+        text += f" ({verification['attempts']} attempts)"
+    return text
+
+def send_file_range(ftp, conn, path, start, end):
+    """
+    Send bytes [start, end) of path over an open data connection and wait
+    for the server to confirm the transfer.
+    """
+    import ssl
+    
+    try:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining:
+                block = f.read(min(UPLOAD_BLOCK_BYTES, remaining))
+                if not block:
+                    break
+                conn.sendall(block)
+                remaining -= len(block)
+        if isinstance(conn, ssl.SSLSocket):
+            conn.unwrap()
+    finally:
+        conn.close()
+    return ftp.voidresp()
+
+def store_file(ftp, config, source, remote_name, digest=None):
+    """
+    STOR source (a local path, or a binary file object that is streamed as
+    it is read) as remote_name. Paths go over several sessions when the
+    target has upload_streams (or FTP_UPLOAD_STREAMS) > 1 and the file is
+    big enough. digest (an UploadDigest) is fed the bytes sent. Blocking.
+    Returns the number of streams used.
+    """
+    callback = digest.update if digest else None
+    if not isinstance(source, str):
+        ftp.storbinary(f'STOR {remote_name}', source, callback=callback)
+        return 1
+    
+    local_path = source
+    size = os.path.getsize(local_path)
+    server = f"{config['host']}:{config['port']}"
+    streams = min(config.get('upload_streams', FTP_UPLOAD_STREAMS), size // MULTI_STREAM_MIN_PART_BYTES)
+    if streams > 1 and server not in single_stream_hosts:
+        try:
+            store_file_multistream(ftp, config, local_path, remote_name, size, streams, digest)
+            return streams
+        except MultiStreamUnavailable as e:
+            single_stream_hosts.add(server)
+            logger.info(f"Multi-stream upload refused by {server}, using a single stream from now on: {e}")
+            if digest:
+                digest.reset()
+    
+    with open(local_path, 'rb') as f:
+        ftp.storbinary(f'STOR {remote_name}', f, callback=callback)
+    return 1
+
+def store_file_multistream(ftp, config, local_path, remote_name, size, streams, digest=None):
+    """
+    Upload local_path in `streams` byte ranges: ftp itself sends the first
+    range with a plain STOR (which creates or truncates the file), extra
+    sessions send the others with REST at their offset. Raises
+    MultiStreamUnavailable if an extra session can't be opened (e.g. 421 Too
+    many connections) or fails its ranged STOR; ftp itself is still usable
+    then. Without a digest to verify later, raises RuntimeError if the
+    remote SIZE doesn't match afterwards.
+    """
+    from ftplib import Error as FTPError
+    from concurrent.futures import ThreadPoolExecutor, wait
+    
+    extra_session_errors = (FTPError, OSError, EOFError)
+    
+    part_size = -(-size // streams)
+    ranges = [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+    
+    with ThreadPoolExecutor(max_workers=len(ranges) + 1) as executor:
+        sessions = []
+        try:
+            opening = [executor.submit(open_ftp_session, config, False) for _ in ranges[1:]]
+            wait(opening)
+            # Keep every session that did open, so all of them get closed
+            # even if another one failed.
+            sessions = [future.result() for future in opening if not future.exception()]
+            for future in opening:
+                error = future.exception()
+                if isinstance(error, extra_session_errors):
+                    raise MultiStreamUnavailable(f"extra session: {error}") from error
+                future.result()
+            
+            ftp.voidcmd('TYPE I')
+            # The first STOR is opened before any ranged one so its truncate
+            # can't wipe data the other sessions already wrote.
+            first_conn = ftp.transfercmd(f'STOR {remote_name}')
+            first_future = executor.submit(send_file_range, ftp, first_conn, local_path, *ranges[0])
+            
+            def send_range(session, start, end):
+                session.voidcmd('TYPE I')
+                conn = session.transfercmd(f'STOR {remote_name}', rest=start)
+                return send_file_range(session, conn, local_path, start, end)
+            
+            range_futures = [
+                executor.submit(send_range, session, start, end)
+                for session, (start, end) in zip(sessions, ranges[1:])
+            ]
+            futures = [first_future] + range_futures
+            if digest:
+                # Ranges finish out of order, so the checksum is computed
+                # from the local file alongside the transfer.
+                futures.append(executor.submit(digest.update_from_file, local_path))
+            wait(futures)
+            # Errors on ftp itself first: those aren't the server refusing
+            # extra streams.
+            first_future.result()
+            for future in range_futures:
+                try:
+                    future.result()
+                except extra_session_errors as e:
+                    raise MultiStreamUnavailable(f"ranged STOR: {e}") from e
+            for future in futures:
+                future.result()
+        finally:
+            for session in sessions:
+                close_ftp_session(session)
+    
+    if not digest:
+        remote_size = ftp.size(remote_name)
+        if remote_size != size:
+            raise RuntimeError(f"Uploaded file is {remote_size} bytes on the server, expected {size}")
+    logger.info(f"Uploaded {remote_name} ({size} bytes) over {len(ranges)} streams")
+
+PULLZONE_FILENAME = 'pullzone_hostnames.txt'
+# Server-side state of the pullzone consumer, reset on every publish.
+PULLZONE_CLEANUP_FILES = ['.next_index', 'assignments.log']
+
+def publish_file(ftp, config, source, upload_name, publish_diff=None, progress=None):
+    """
+    Publish source (a local path or binary file object, see store_file) in
+    ftp's current directory: upload it as upload_name, replace
+    pullzone_hostnames.txt with it, delete the consumer's state files,
+    upload patch files and record the published snapshot. Blocking.
+    With VERIFY_PUBLISH the upload is checked on the server before the
+    rename and sent again on a mismatch (a file object source must be
+    seekable then).
+    progress(step, old_file_deleted) is called before each step ('store',
+    'verify', 'list', 'delete_old', 'rename', 'cleanup').
+    Returns dict with streams, old_file_deleted, cleaned, patches_uploaded,
+    verification (see verify_upload, plus attempts; None if disabled) and
+    timings (seconds for 'store', 'verify' and 'replace & cleanup').
+    """
+    from ftp_health import track, transfer_timeout
+    
+    progress = progress or (lambda step, old_file_deleted=False: None)
+    target_filename = PULLZONE_FILENAME
+    server = f"{config['host']}:{config['port']}"
+    source_size = os.path.getsize(source) if isinstance(source, str) else None
+    set_ftp_timeout(ftp, transfer_timeout(server, source_size))
+    timings = {'store': 0.0}
+    verification = None
+    algorithm = None
+    
+    if VERIFY_PUBLISH:
+        started = time.perf_counter()
+        _, algorithm = get_checksum_command(ftp, config)
+        timings['verify'] = time.perf_counter() - started
+    
+    for attempt in range(1, PUBLISH_VERIFY_RETRIES + 2):
+        progress('store')
+        started = time.perf_counter()
+        digest = UploadDigest(algorithm) if VERIFY_PUBLISH else None
+        with track(server, 'transfer', source_size):
+            streams = store_file(ftp, config, source, upload_name, digest)
+        timings['store'] += time.perf_counter() - started
+        size = f"{source_size} bytes" if source_size is not None else "streamed"
+        logger.info(f"File uploaded as {upload_name}, size: {size}, streams: {streams}")
+        if not VERIFY_PUBLISH:
+            break
+        
+        progress('verify')
+        started = time.perf_counter()
+        verification = verify_upload(ftp, config, upload_name, digest)
+        verification['attempts'] = attempt
+        timings['verify'] += time.perf_counter() - started
+        if verification['ok']:
+            break
+        if attempt > PUBLISH_VERIFY_RETRIES:
+            raise RuntimeError(
+                f"Uploaded file doesn't match on the server after {attempt} attempts "
+                f"(size {verification['remote_size']}, expected {verification['size']})"
+            )
+        logger.warning(f"Upload of {upload_name} doesn't match on the server, uploading again")
+        if not isinstance(source, str):
+            source.seek(0)
+    
+    stored = time.perf_counter()
+    progress('list')
+    files = ftp.nlst()
+    logger.info(f"Directory listing: {files}")
+    
+    old_file_deleted = False
+    if target_filename in files:
+        progress('delete_old')
+        ftp.delete(target_filename)
+        old_file_deleted = True
+        logger.info(f"Deleted old {target_filename}")
+    
+    progress('rename', old_file_deleted)
+    ftp.rename(upload_name, target_filename)
+    logger.info(f"Renamed {upload_name} to {target_filename}")
+    
+    cleaned = []
+    progress('cleanup', old_file_deleted)
+    for cleanup_file in PULLZONE_CLEANUP_FILES:
+        try:
+            if cleanup_file in files:
+                ftp.delete(cleanup_file)
+                cleaned.append(cleanup_file)
+                logger.info(f"Deleted {cleanup_file}")
+        except Exception as e:
+            logger.info(f"Could not delete {cleanup_file}: {e}")
+    
+    patches_uploaded = False
+    if publish_diff:
+        if publish_diff['added_path']:
+            base_name = os.path.splitext(target_filename)[0]
+            for patch_path, patch_name in (
+                (publish_diff['added_path'], f"{base_name}.added.txt"),
+                (publish_diff['removed_path'], f"{base_name}.removed.txt"),
+            ):
+                with open(patch_path, 'rb') as f:
+                    ftp.storbinary(f'STOR {patch_name}', f)
+                logger.info(f"Uploaded patch file {patch_name}")
+            patches_uploaded = True
+        
+        try:
+            commit_published_snapshot(config, publish_diff['snapshot_path'])
+        except Exception as e:
+            logger.error(f"Error recording published snapshot: {e}")
+    
+    timings['replace & cleanup'] = time.perf_counter() - stored
+    return {
+        'streams': streams,
+        'old_file_deleted': old_file_deleted,
+        'cleaned': cleaned,
+        'patches_uploaded': patches_uploaded,
+        'verification': verification,
+        'timings': timings,
+    }
+
+# Documents are streamed to disk in chunks so cleaning can start on the
+# first complete lines while the rest is still downloading.
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+download_client = None
+
+def get_download_client():
+    """
+    HTTP client for file downloads, created on first use and reused so
+    later uploads skip the TLS handshake with the file server.
+    """
+    global download_client
+    if download_client is None:
+        import httpx
+        
+        download_client = httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT)
+    return download_client
+
+async def download_telegram_file(file, path, on_progress):
+    """
+    Download a Telegram file to path, calling on_progress(bytes_on_disk)
+    after every chunk.
+    """
+    if not file.file_path.startswith(('http://', 'https://')):
+        # Local Bot API server: the file is already on disk.
+        await file.download_to_drive(path)
+        on_progress(os.path.getsize(path))
+        return
+    
+    written = 0
+    async with get_download_client().stream('GET', file.file_path) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+                f.write(chunk)
+                f.flush()
+                written += len(chunk)
+                on_progress(written)
+
+async def download_and_clean(file, tmp_path, cleaned_path, rejected_path, timings):
+    """
+    Download a document and clean it at the same time. Cleaning runs in a
+    worker thread on each batch of complete lines as it lands on disk.
+    Returns (lines_processed, lines_cleaned, rejections), or None if
+    cleaning failed (the download itself still completes).
+    """
+    from cleaning import StreamingCleaner
+    
+    started = time.perf_counter()
+    progress = asyncio.Queue()
+    
+    async def download():
+        try:
+            await download_telegram_file(file, tmp_path, progress.put_nowait)
+        finally:
+            timings['download'] = time.perf_counter() - started
+            progress.put_nowait(None)
+    
+    download_task = asyncio.create_task(download())
+    cleaner = StreamingCleaner(tmp_path, cleaned_path, rejected_path)
+    result = None
+    try:
+        done = False
+        while not done:
+            available = await progress.get()
+            while available is not None and not progress.empty():
+                available = progress.get_nowait()
+            done = available is None
+            if not done and cleaner is not None:
+                try:
+                    await asyncio.to_thread(cleaner.feed, available)
+                except Exception as e:
+                    logger.error(f"Error cleaning file: {e}")
+                    cleaner.close()
+                    cleaner = None
+        
+        await download_task
+        if cleaner is not None:
+            try:
+                result = await asyncio.to_thread(cleaner.finish)
+            except Exception as e:
+                logger.error(f"Error cleaning file: {e}")
+    finally:
+        if cleaner is not None:
+            cleaner.close()
+        if not download_task.done():
+            download_task.cancel()
+        if 'download' in timings:
+            timings['clean after download'] = time.perf_counter() - started - timings['download']
+    return result
+
+def format_stage_timings(timings):
+    return ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
+
+async def upload_start(query_or_update, context: ContextTypes.DEFAULT_TYPE, is_callback=False):
+    user_id = query_or_update.from_user.id if is_callback else query_or_update.effective_user.id
+    config = load_ftp_config(user_id)
+    
+    if not config:
+        error_msg = (
+            "❌ <b>No FTP Configuration Found</b>\n\n"
+            "Please setup your FTP credentials first."
+        )
+        try:
+            if is_callback:
                 await query_or_update.edit_message_text(
                     error_msg,
                     parse_mode='HTML',
@@ -537,7 +2263,7 @@ async def upload_start(query_or_update, context: ContextTypes.DEFAULT_TYPE, is_c
         "📤 <b>Upload File to FTP</b>\n\n"
         "Send any text file (any filename is OK!)\n\n"
         "📝 <b>What happens:</b>\n"
-        "   1️⃣ Clean URLs (remove http/https)\n"
+        "   1️⃣ Clean URLs (remove http/https) & drop invalid hostnames\n"
         "   2️⃣ Upload with original name\n"
         "   3️⃣ Delete old <code>pullzone_hostnames.txt</code>\n"
         "   4️⃣ Rename to <code>pullzone_hostnames.txt</code>\n"
@@ -558,16 +2284,24 @@ async def upload_start(query_or_update, context: ContextTypes.DEFAULT_TYPE, is_c
                 upload_msg,
                 parse_mode='HTML'
             )
+        start_ftp_prewarm(user_id, config)
         return UPLOAD_FILE
     except Exception as e:
         logger.error(f"Error in upload_start: {e}")
         return ConversationHandler.END
 
 async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    import tempfile
+    from ftplib import error_perm
+    from cleaning import format_rejections
+    from ftp_health import HostUnavailable
+    
+    started = time.perf_counter()
     user_id = update.effective_user.id
     config = load_ftp_config(user_id)
     
     if not config:
+        discard_ftp_prewarm(user_id)
         await update.message.reply_text(
             "❌ FTP not configured. Setup cancelled.",
             reply_markup=get_back_to_menu_keyboard()
@@ -595,41 +2329,51 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status_msg = await update.message.reply_text("⬇️ <b>Downloading file...</b>", parse_mode='HTML')
     
     tmp_path = None
+    rejected_tmp_path = None
+    rejections = {}
+    publish_diff = None
+    publish_lock_token = None
     ftp = None
     temp_upload_name = None
+    timings = {}
     
     try:
+        # The FTP handshake runs alongside the download and cleaning, unless
+        # a session was already pre-warmed when the upload flow opened.
+        if user_id not in prewarmed_ftp_sessions:
+            start_ftp_prewarm(user_id, config)
+        
         file = await context.bot.get_file(document.file_id)
         
         with tempfile.NamedTemporaryFile(delete=False, suffix='.txt') as tmp_file:
-            await file.download_to_drive(tmp_file.name)
             tmp_path = tmp_file.name
+        cleaned_tmp_path = tmp_path + '.cleaned'
+        rejected_tmp_path = tmp_path + '.rejected'
         
-        await status_msg.edit_text(
-            "📦 <b>File downloaded</b>\n"
-            "🧹 Processing & cleaning URLs...",
-            parse_mode='HTML'
-        )
+        result = await download_and_clean(file, tmp_path, cleaned_tmp_path, rejected_tmp_path, timings)
         
-        cleaned_tmp_path = tmp_path + '.cleaned'
-        try:
-            lines_processed, lines_cleaned = process_file_content(tmp_path, cleaned_tmp_path)
-            logger.info(f"Processed {lines_processed} lines, cleaned {lines_cleaned} URLs")
+        if result:
+            lines_processed, lines_cleaned, rejections = result
+            lines_rejected = sum(rejections.values())
+            logger.info(f"Processed {lines_processed} lines, cleaned {lines_cleaned} URLs, rejected {lines_rejected}")
             
             os.unlink(tmp_path)
             tmp_path = cleaned_tmp_path
             
-            await status_msg.edit_text(
+            rejected_text = f"🚫 <b>Rejected {lines_rejected} invalid lines</b>\n" if lines_rejected else ""
+            await edit_progress(
+                context.bot,
+                status_msg,
                 f"� <b>File downloaded</b>\n"
                 f"✅ <b>Processed {lines_processed} lines</b>\n"
                 f"🧹 <b>Cleaned {lines_cleaned} URLs</b>\n"
-                f"�🔄 Connecting to FTP...",
-                parse_mode='HTML'
+                f"{rejected_text}"
+                f"�🔄 Connecting to FTP..."
             )
-        except Exception as e:
-            logger.error(f"Error cleaning file: {e}")
+        else:
             if os.path.exists(cleaned_tmp_path):
                 os.unlink(cleaned_tmp_path)
+            rejections = {}
             await status_msg.edit_text(
                 "📦 <b>File downloaded</b>\n"
                 "⚠️ Could not clean URLs, uploading as-is...\n"
@@ -639,101 +2383,79 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             lines_processed = 0
             lines_cleaned = 0
         
-        ftp = FTP_TLS(timeout=30)
-        ftp.connect(config['host'], config['port'])
-        ftp.login(config['user'], config['pass'])
-        ftp.prot_p()
+        stage_started = time.perf_counter()
+        publish_lock_token = await acquire_publish_lock(config, status_msg)
         
-        await status_msg.edit_text(
-            f"📦 <b>File downloaded</b>\n"
-            f"✅ <b>Connected to FTP</b>\n"
-            f"📂 Navigating to {config['path']}...",
-            parse_mode='HTML'
-        )
+        try:
+            publish_diff = await asyncio.to_thread(
+                compute_publish_diff, config, tmp_path,
+                config.get('publish_patches', PUBLISH_PATCH_FILES)
+            )
+            logger.info(f"Publish diff: +{publish_diff['added']} / -{publish_diff['removed']}")
+        except Exception as e:
+            logger.error(f"Error computing publish diff: {e}")
+            publish_diff = None
+        timings['lock & diff'] = time.perf_counter() - stage_started
         
-        ftp.cwd(config['path'])
+        stage_started = time.perf_counter()
+        ftp = await take_prewarmed_ftp(user_id, config)
+        prewarmed = ftp is not None
+        if not prewarmed:
+            ftp = await asyncio.to_thread(open_ftp_session, config)
+        timings['ftp connect wait'] = time.perf_counter() - stage_started
         
         original_filename = document.file_name if document.file_name else "upload.txt"
         temp_upload_name = original_filename
-        target_filename = 'pullzone_hostnames.txt'
+        target_filename = PULLZONE_FILENAME
         
         logger.info(f"Original filename: {original_filename}")
         
-        await status_msg.edit_text(
-            f"📦 <b>File downloaded</b>\n"
-            f"✅ <b>Connected to FTP</b>\n"
-            f"📂 <b>In directory</b>\n"
-            f"📤 Uploading as <code>{temp_upload_name}</code>...",
-            parse_mode='HTML'
-        )
-        
-        with open(tmp_path, 'rb') as f:
-            ftp.storbinary(f'STOR {temp_upload_name}', f)
-        
-        logger.info(f"File uploaded as {temp_upload_name}, size: {file_size_bytes} bytes")
-        
-        await status_msg.edit_text(
-            f"📦 <b>File downloaded</b>\n"
-            f"✅ <b>Connected to FTP</b>\n"
-            f"📂 <b>In directory</b>\n"
-            f"✅ <b>File uploaded</b>\n"
-            f"📋 Listing directory...",
-            parse_mode='HTML'
-        )
-        
-        files = ftp.nlst()
-        logger.info(f"Directory listing: {files}")
+        loop = asyncio.get_running_loop()
         
-        old_file_deleted = False
-        if target_filename in files:
-            await status_msg.edit_text(
+        def show_publish_step(step, old_file_deleted=False):
+            text = (
                 f"📦 <b>File downloaded</b>\n"
                 f"✅ <b>Connected to FTP</b>\n"
                 f"📂 <b>In directory</b>\n"
-                f"✅ <b>File uploaded</b>\n"
-                f"🗑️ Deleting old {target_filename}...",
-                parse_mode='HTML'
             )
-            ftp.delete(target_filename)
-            old_file_deleted = True
-            logger.info(f"Deleted old {target_filename}")
+            if step == 'store':
+                text += f"📤 Uploading as <code>{temp_upload_name}</code>..."
+            elif step == 'verify':
+                text += "✅ <b>File uploaded</b>\n🔍 Verifying on server..."
+            elif step == 'list':
+                text += "✅ <b>File uploaded</b>\n📋 Listing directory..."
+            elif step == 'delete_old':
+                text += f"✅ <b>File uploaded</b>\n🗑️ Deleting old {target_filename}..."
+            else:
+                text += (
+                    f"✅ <b>File uploaded</b>\n"
+                    f"{('🗑️ <b>Old file deleted</b>' if old_file_deleted else 'ℹ️ <b>No old file</b>')}\n"
+                )
+                if step == 'rename':
+                    text += f"🔄 Renaming to {target_filename}..."
+                else:
+                    text += f"✅ <b>Renamed to {target_filename}</b>\n🧹 Cleaning up..."
+            future = asyncio.run_coroutine_threadsafe(edit_progress(context.bot, status_msg, text), loop)
+            try:
+                future.result(timeout=PROGRESS_EDIT_TIMEOUT)
+            except Exception as e:
+                # Never let a status edit abort publish_file, which may be
+                # between deleting the old file and renaming the new one.
+                logger.info(f"Could not update status message: {str(e) or type(e).__name__}")
         
-        await status_msg.edit_text(
-            f"📦 <b>File downloaded</b>\n"
-            f"✅ <b>Connected to FTP</b>\n"
-            f"📂 <b>In directory</b>\n"
-            f"✅ <b>File uploaded</b>\n"
-            f"{('🗑️ <b>Old file deleted</b>' if old_file_deleted else 'ℹ️ <b>No old file</b>')}\n"
-            f"🔄 Renaming to {target_filename}...",
-            parse_mode='HTML'
+        published = await asyncio.to_thread(
+            publish_file, ftp, config, tmp_path, temp_upload_name, publish_diff, show_publish_step
         )
-        
-        ftp.rename(temp_upload_name, target_filename)
-        logger.info(f"Renamed {temp_upload_name} to {target_filename}")
-        
-        cleanup_files = ['.next_index', 'assignments.log']
-        cleaned = []
-        
-        await status_msg.edit_text(
-            f"📦 <b>File downloaded</b>\n"
-            f"✅ <b>Connected to FTP</b>\n"
-            f"📂 <b>In directory</b>\n"
-            f"✅ <b>File uploaded</b>\n"
-            f"{('🗑️ <b>Old file deleted</b>' if old_file_deleted else 'ℹ️ <b>No old file</b>')}\n"
-            f"✅ <b>Renamed to {target_filename}</b>\n"
-            f"🧹 Cleaning up...",
-            parse_mode='HTML'
+        old_file_deleted = published['old_file_deleted']
+        cleaned = published['cleaned']
+        patches_uploaded = published['patches_uploaded']
+        timings.update(published['timings'])
+        logger.info(
+            f"Published {target_filename} for user {user_id} in {time.perf_counter() - started:.2f}s "
+            f"({'pre-warmed' if prewarmed else 'new'} FTP session): {format_stage_timings(timings)}; "
+            f"{ftp.handshake_summary() or 'no data connections'}"
         )
         
-        for cleanup_file in cleanup_files:
-            try:
-                if cleanup_file in files:
-                    ftp.delete(cleanup_file)
-                    cleaned.append(cleanup_file)
-                    logger.info(f"Deleted {cleanup_file}")
-            except Exception as e:
-                logger.info(f"Could not delete {cleanup_file}: {e}")
-        
         cleanup_text = f"🧹 Cleaned: {', '.join(cleaned)}" if cleaned else ""
         
         success_details = (
@@ -747,6 +2469,17 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if lines_cleaned > 0:
             success_details += f"🧹 Cleaned {lines_cleaned}/{lines_processed} URLs\n"
         
+        if rejections:
+            success_details += f"🚫 Rejected {sum(rejections.values())} lines ({format_rejections(rejections)})\n"
+        
+        if publish_diff:
+            success_details += f"{format_publish_diff(publish_diff)}\n"
+            if patches_uploaded:
+                success_details += "🩹 Patch files: <code>.added.txt</code> / <code>.removed.txt</code>\n"
+        
+        if published['verification']:
+            success_details += f"{format_verification(published['verification'])}\n"
+        
         success_details += f"\n{('🗑️ Old file replaced' if old_file_deleted else '🆕 New file created')}\n"
         
         if cleanup_text:
@@ -758,6 +2491,11 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_back_to_menu_keyboard()
         )
         
+        try:
+            await asyncio.to_thread(archive_upload, user_id, config, tmp_path, original_filename, publish_diff)
+        except Exception as e:
+            logger.error(f"Error archiving upload: {e}")
+        
     except error_perm as e:
         error_msg = (
             f"❌ <b>FTP Permission Error</b>\n\n"
@@ -769,6 +2507,17 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='HTML',
             reply_markup=get_back_to_menu_keyboard()
         )
+    except HostUnavailable as e:
+        error_msg = (
+            f"⛔ <b>FTP Server Unreachable</b>\n\n"
+            f"{str(e)}\n\n"
+            f"Please try again later."
+        )
+        await status_msg.edit_text(
+            error_msg,
+            parse_mode='HTML',
+            reply_markup=get_back_to_menu_keyboard()
+        )
     except TimeoutError:
         error_msg = (
             f"❌ <b>Connection Timeout</b>\n\n"
@@ -793,24 +2542,39 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_back_to_menu_keyboard()
         )
     finally:
+        discard_ftp_prewarm(user_id)
         if ftp:
-            try:
-                ftp.quit()
-            except:
-                try:
-                    ftp.close()
-                except:
-                    pass
+            await asyncio.to_thread(close_ftp_session, ftp)
+        
+        if publish_lock_token:
+            await asyncio.to_thread(release_publish_lock, config, publish_lock_token)
         
-        if tmp_path and os.path.exists(tmp_path):
+        if rejections and rejected_tmp_path and os.path.exists(rejected_tmp_path):
             try:
-                os.unlink(tmp_path)
+                with open(rejected_tmp_path, 'rb') as f:
+                    await update.message.reply_document(
+                        document=f,
+                        filename='rejected_lines.txt',
+                        caption=f"🚫 {sum(rejections.values())} lines were not valid hostnames and were left out"
+                    )
             except Exception as e:
-                logger.error(f"Error deleting temp file: {e}")
+                logger.error(f"Error sending rejection report: {e}")
+        
+        diff_paths = (
+            (publish_diff['snapshot_path'], publish_diff['added_path'], publish_diff['removed_path'])
+            if publish_diff else ()
+        )
+        for path in (tmp_path, rejected_tmp_path) + diff_paths:
+            if path and os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except Exception as e:
+                    logger.error(f"Error deleting temp file: {e}")
     
     return ConversationHandler.END
 
 async def upload_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    discard_ftp_prewarm(update.effective_user.id)
     try:
         await update.message.reply_text(
             "❌ Upload cancelled.",
@@ -820,6 +2584,175 @@ async def upload_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in upload_cancel: {e}")
     return ConversationHandler.END
 
+async def show_history(query_or_update, user_id, is_callback=False):
+    import datetime
+    
+    config = load_ftp_config(user_id)
+    if not config:
+        text = "❌ FTP not configured. Please setup FTP first."
+        entries = []
+    else:
+        entries = await asyncio.to_thread(load_history, user_id, config)
+        text = f"📜 <b>Upload History</b>\n📂 <code>{config['host']}{config['path']}</code>\n\n"
+        if not entries:
+            text += "No uploads yet. Published files will show up here."
+    
+    buttons = []
+    for number, entry in enumerate(entries, 1):
+        published_at = datetime.datetime.fromtimestamp(entry['published_at'], datetime.timezone.utc)
+        archived = os.path.exists(get_history_object_path(entry['sha256']))
+        status = " (latest)" if number == 1 else "" if archived else " (expired)"
+        details = f"{entry['hostnames']:,} hostnames" if entry['hostnames'] is not None else f"{entry['size']:,} bytes"
+        if entry['added'] is not None:
+            details += f", +{entry['added']:,} / -{entry['removed']:,}"
+        if entry['republished_from']:
+            details += ", republished"
+        text += (
+            f"<b>#{number}</b> {published_at:%Y-%m-%d %H:%M} UTC{status}\n"
+            f"   <code>{entry['file_name']}</code> · {details}\n"
+        )
+        if archived:
+            buttons.append(InlineKeyboardButton(f"♻️ Republish #{number}", callback_data=f"republish:{entry['id']}"))
+    
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append([InlineKeyboardButton("🏠 Back to Menu", callback_data="menu_main")])
+    
+    try:
+        if is_callback:
+            await query_or_update.edit_message_text(
+                text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        else:
+            await query_or_update.message.reply_text(
+                text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+    except Exception as e:
+        logger.error(f"Error showing history: {e}")
+
+async def republish_upload(query, user_id, entry_id):
+    """
+    Publish an archived upload again, streaming it from the archive to the
+    server without downloading or cleaning anything.
+    """
+    import gzip
+    import tempfile
+    from ftplib import error_perm
+    
+    started = time.perf_counter()
+    config = load_ftp_config(user_id)
+    if not config:
+        await query.edit_message_text(
+            "❌ FTP not configured. Please setup FTP first.",
+            reply_markup=get_back_to_menu_keyboard()
+        )
+        return
+    
+    entry, object_path = await asyncio.to_thread(find_history_entry, user_id, config, entry_id)
+    if not entry:
+        await query.edit_message_text(
+            "❌ This version is no longer in the upload history.",
+            reply_markup=get_back_to_menu_keyboard()
+        )
+        return
+    # Mark it recently used so a concurrent upload can't evict it.
+    os.utime(object_path)
+    
+    status_msg = query.message
+    await query.edit_message_text(
+        f"♻️ <b>Republishing</b> <code>{entry['file_name']}</code>\n🔄 Connecting to FTP...",
+        parse_mode='HTML'
+    )
+    
+    publish_lock_token = None
+    publish_diff = None
+    work_path = None
+    ftp = None
+    try:
+        publish_lock_token = await acquire_publish_lock(config, status_msg)
+        
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.republish') as work_file:
+            work_path = work_file.name
+        try:
+            publish_diff = await asyncio.to_thread(
+                compute_publish_diff, config, object_path,
+                config.get('publish_patches', PUBLISH_PATCH_FILES), work_path
+            )
+        except Exception as e:
+            logger.error(f"Error computing publish diff: {e}")
+        
+        ftp = await asyncio.to_thread(open_ftp_session, config)
+        await status_msg.edit_text(
+            f"♻️ <b>Republishing</b> <code>{entry['file_name']}</code>\n"
+            f"✅ <b>Connected to FTP</b>\n"
+            f"📤 Uploading from history...",
+            parse_mode='HTML'
+        )
+        
+        upload_name = f"{entry['file_name']}.{uuid.uuid4().hex[:8]}.tmp"
+        
+        def publish_from_archive():
+            with gzip.open(object_path, 'rb') as source:
+                return publish_file(ftp, config, source, upload_name, publish_diff)
+        
+        published = await asyncio.to_thread(publish_from_archive)
+        await asyncio.to_thread(
+            add_history_entry, user_id, config, entry['sha256'], entry['file_name'], entry['size'],
+            publish_diff, entry['id']
+        )
+        logger.info(
+            f"Republished {entry['sha256'][:12]} for user {user_id} in {time.perf_counter() - started:.2f}s: "
+            f"{format_stage_timings(published['timings'])}"
+        )
+        
+        success_details = (
+            f"✅ <b>Republished!</b>\n\n"
+            f"📥 Version: <code>{entry['file_name']}</code>\n"
+            f"📄 Saved as: <code>{PULLZONE_FILENAME}</code>\n"
+            f"📂 Location: <code>{config['path']}/</code>\n"
+            f"💾 Size: {entry['size']:,} bytes\n"
+        )
+        if publish_diff:
+            success_details += f"{format_publish_diff(publish_diff)}\n"
+        if published['verification']:
+            success_details += f"{format_verification(published['verification'])}\n"
+        if published['cleaned']:
+            success_details += f"🧹 Cleaned: {', '.join(published['cleaned'])}\n"
+        
+        await status_msg.edit_text(
+            success_details,
+            parse_mode='HTML',
+            reply_markup=get_back_to_menu_keyboard()
+        )
+    
+    except error_perm as e:
+        await status_msg.edit_text(
+            f"❌ <b>FTP Permission Error</b>\n\n"
+            f"Details: <code>{str(e)}</code>\n\n"
+            f"Check if you have write permissions.",
+            parse_mode='HTML',
+            reply_markup=get_back_to_menu_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Republish error: {e}\n{traceback.format_exc()}")
+        await status_msg.edit_text(
+            f"❌ <b>Republish Failed</b>\n\n"
+            f"Error: <code>{str(e)}</code>",
+            parse_mode='HTML',
+            reply_markup=get_back_to_menu_keyboard()
+        )
+    finally:
+        if ftp:
+            await asyncio.to_thread(close_ftp_session, ftp)
+        if publish_lock_token:
+            await asyncio.to_thread(release_publish_lock, config, publish_lock_token)
+        diff_paths = (
+            (publish_diff['snapshot_path'], publish_diff['added_path'], publish_diff['removed_path'])
+            if publish_diff else ()
+        )
+        for path in (work_path,) + diff_paths:
+            if path and os.path.exists(path):
+                os.unlink(path)
+
 async def view_config(query, user_id):
     config = load_ftp_config(user_id)
     
@@ -834,6 +2767,8 @@ async def view_config(query, user_id):
     
     masked_pass = config['pass'][:2] + '*' * (len(config['pass']) - 4) + config['pass'][-2:] if len(config['pass']) > 4 else '****'
     
+    encryption_text = "🔐 <b>Encrypted at rest</b>\n" if CONFIG_MASTER_KEY else ""
+    
     keyboard = [
         [InlineKeyboardButton("🔄 Update Config", callback_data="menu_setup")],
         [InlineKeyboardButton("🗑️ Delete Config", callback_data="delete_config")],
@@ -848,6 +2783,7 @@ async def view_config(query, user_id):
         f"🔒 <b>Password:</b> <code>{masked_pass}</code>\n"
         f"📂 <b>Path:</b> <code>{config['path']}</code>\n\n"
         f"💡 <b>Config file:</b> ftp_config.json\n"
+        f"{encryption_text}"
         f"✅ This configuration is <b>permanent</b> - saved locally!",
         parse_mode='HTML',
         reply_markup=InlineKeyboardMarkup(keyboard)
@@ -869,30 +2805,14 @@ async def delete_config(query, user_id):
 
 async def confirm_delete_config(query, user_id):
     try:
-        if os.path.exists(FTP_CONFIG_FILE):
-            with open(FTP_CONFIG_FILE, 'r') as f:
-                configs = json.load(f)
-            
-            if str(user_id) in configs:
-                del configs[str(user_id)]
-                
-                with open(FTP_CONFIG_FILE, 'w') as f:
-                    json.dump(configs, f, indent=2)
-                
-                logger.info(f"Config deleted for user {user_id}")
-                
-                await query.edit_message_text(
-                    "✅ <b>Configuration Deleted</b>\n\n"
-                    "Your FTP credentials have been removed.\n"
-                    "Use Setup to configure again.",
-                    parse_mode='HTML',
-                    reply_markup=get_back_to_menu_keyboard()
-                )
-            else:
-                await query.edit_message_text(
-                    "ℹ️ No configuration found to delete.",
-                    reply_markup=get_back_to_menu_keyboard()
-                )
+        if delete_ftp_config(user_id):
+            await query.edit_message_text(
+                "✅ <b>Configuration Deleted</b>\n\n"
+                "Your FTP credentials have been removed.\n"
+                "Use Setup to configure again.",
+                parse_mode='HTML',
+                reply_markup=get_back_to_menu_keyboard()
+            )
         else:
             await query.edit_message_text(
                 "ℹ️ No configuration found to delete.",
@@ -951,7 +2871,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif query.data == "confirm_delete":
             await confirm_delete_config(query, query.from_user.id)
         
+        elif query.data == "menu_history":
+            await show_history(query, query.from_user.id, is_callback=True)
+        
+        elif query.data.startswith("republish:"):
+            await republish_upload(query, query.from_user.id, query.data.split(':', 1)[1])
+        
         elif query.data == "cancel_setup":
+            clear_setup_fields(context.user_data)
             await query.edit_message_text(
                 "❌ Setup cancelled.",
                 reply_markup=get_back_to_menu_keyboard()
@@ -969,7 +2896,454 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
+# Multi-worker mode: one poller process fetches updates and routes them by
+# user to BOT_WORKERS worker processes through the shared state backend, so
+# each user's conversation is always handled by the same worker.
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '1'))
+UPDATE_BATCH_SIZE = 100
+UPDATE_POLL_INTERVAL = 0.2
+# Set to 0 to answer messages that arrived while the bot was asleep instead
+# of discarding them on startup.
+DROP_PENDING_UPDATES = os.environ.get('DROP_PENDING_UPDATES', '1') != '0'
+
+# Built once at import; every setup step shares the same filter objects.
+TEXT_INPUT_FILTER = filters.TEXT & ~filters.COMMAND
+
+def build_application(token, workers=1):
+    # Each worker process throttles on its own, so the bot-wide limit is
+    # split between them.
+    rate_limiter = TelegramRateLimiter(
+        global_rate=TELEGRAM_GLOBAL_RATE / workers,
+        global_burst=max(1, TELEGRAM_GLOBAL_BURST / workers)
+    )
+    builder = Application.builder().token(token).rate_limiter(rate_limiter)
+    persistent = STATE_BACKEND != 'json'
+    if persistent:
+        builder = builder.persistence(StatePersistence(get_state_backend()))
+    application = builder.build()
+    
+    setup_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('setup', lambda u, c: setup_start(u, c, is_callback=False)),
+            CallbackQueryHandler(button_handler, pattern="^menu_setup$")
+        ],
+        states={
+            FTP_HOST: [MessageHandler(TEXT_INPUT_FILTER, ftp_host)],
+            FTP_PORT: [MessageHandler(TEXT_INPUT_FILTER, ftp_port)],
+            FTP_USER: [MessageHandler(TEXT_INPUT_FILTER, ftp_user)],
+            FTP_PASS: [MessageHandler(TEXT_INPUT_FILTER, ftp_pass)],
+            FTP_PATH: [MessageHandler(TEXT_INPUT_FILTER, ftp_path)],
+        },
+        fallbacks=[
+            CommandHandler('cancel', setup_cancel),
+            CallbackQueryHandler(button_handler, pattern="^cancel_setup$")
+        ],
+        allow_reentry=True,
+        name='setup',
+        persistent=persistent
+    )
+    
+    upload_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('upload', lambda u, c: upload_start(u, c, is_callback=False)),
+            CallbackQueryHandler(button_handler, pattern="^menu_upload$")
+        ],
+        states={
+            # Non-blocking: an upload (including waiting up to
+            # PUBLISH_LOCK_WAIT for another one to the same target) mustn't
+            # hold up other users' updates on this worker.
+            UPLOAD_FILE: [MessageHandler(filters.Document.ALL, upload_file, block=False)],
+        },
+        fallbacks=[CommandHandler('cancel', upload_cancel)],
+        allow_reentry=True,
+        name='upload',
+        persistent=persistent
+    )
+    
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", lambda u, c: show_help(u, is_callback=False)))
+    application.add_handler(CommandHandler("status", lambda u, c: test_connection(u, u.effective_user.id, is_callback=False)))
+    application.add_handler(CommandHandler("history", lambda u, c: show_history(u, u.effective_user.id, is_callback=False)))
+    application.add_handler(setup_handler)
+    application.add_handler(upload_handler)
+    application.add_handler(CallbackQueryHandler(button_handler))
+    
+    return application
+
+def get_update_partition(update, workers):
+    """
+    Route updates by user (or chat) so a conversation stays on one worker.
+    """
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % workers
+
+async def run_update_poller(token, workers):
+    """
+    Fetch updates with long polling and queue them for the workers.
+    """
+    backend = get_state_backend()
+    async with Bot(token) as bot:
+        await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+        logger.info(f"📡 Routing updates to {workers} workers...")
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except NetworkError as e:
+                logger.error(f"Error fetching updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            for update in updates:
+                await asyncio.to_thread(
+                    backend.push_update, get_update_partition(update, workers), json.dumps(update.to_dict())
+                )
+                offset = update.update_id + 1
+
+async def run_update_worker(token, worker_index):
+    """
+    Handle the updates the poller routed to this worker.
+    """
+    backend = get_state_backend()
+    application = build_application(token, BOT_WORKERS)
+    async with application:
+        await application.start()
+        logger.info(f"🤖 Worker {worker_index} started")
+        try:
+            while True:
+                payloads = await asyncio.to_thread(backend.pop_updates, worker_index, UPDATE_BATCH_SIZE)
+                for payload in payloads:
+                    await application.update_queue.put(Update.de_json(json.loads(payload), application.bot))
+                if not payloads:
+                    await asyncio.sleep(UPDATE_POLL_INTERVAL)
+        finally:
+            await application.stop()
+
+# Batch publishing from the command line (python main.py publish ...), for
+# automation that regenerates lists for many targets. Uses the same
+# cleaning, locking, diff and publish steps as upload_file.
+BATCH_CONCURRENCY = 4
+# The json backend keeps publish locks in one process's memory, so the bot
+# and a batch run would not see each other's. Both hold this file lock while
+# they run instead.
+JSON_BACKEND_LOCK_FILE = os.path.join(PUBLISHED_STATE_DIR, 'json_backend.lock')
+json_backend_lock_file = None
+
+def claim_json_backend(blocking=False):
+    """
+    Hold JSON_BACKEND_LOCK_FILE until this process exits. Returns False if
+    another process holds it (and blocking is False). Always True where
+    fcntl isn't available.
+    """
+    global json_backend_lock_file
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    
+    os.makedirs(PUBLISHED_STATE_DIR, exist_ok=True)
+    lock_file = open(JSON_BACKEND_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    json_backend_lock_file = lock_file
+    return True
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def resolve_batch_jobs(file_specs, target_ids):
+    """
+    Turn FILE / TARGET=FILE arguments into (target_id, config, path) jobs.
+    A plain FILE goes to every selected target (all configured targets if
+    none were given).
+    """
+    configs = dict(get_state_backend().items('config'))
+    selected = target_ids or sorted(configs)
+    missing = [target_id for target_id in selected if target_id not in configs]
+    if missing:
+        raise ValueError(f"No FTP config for target(s): {', '.join(missing)}")
+    
+    jobs = []
+    for spec in file_specs:
+        target_id, separator, path = spec.partition('=')
+        if separator and not os.path.exists(spec):
+            if target_id not in configs:
+                raise ValueError(f"No FTP config for target: {target_id}")
+            jobs.append((target_id, configs[target_id], path))
+        else:
+            jobs.extend((target_id, configs[target_id], spec) for target_id in selected)
+    
+    for path in {path for _, _, path in jobs}:
+        if not os.path.isfile(path):
+            raise ValueError(f"File not found: {path}")
+    return jobs
+
+async def clean_batch_file(path, work_dir, index):
+    from cleaning import process_file_content
+    
+    cleaned_path = os.path.join(work_dir, f"{index}.cleaned")
+    started = time.perf_counter()
+    lines_processed, lines_cleaned, rejections = await asyncio.to_thread(
+        process_file_content, path, cleaned_path, os.path.join(work_dir, f"{index}.rejected")
+    )
+    return {
+        'cleaned_path': cleaned_path,
+        'lines_processed': lines_processed,
+        'lines_cleaned': lines_cleaned,
+        'rejected': sum(rejections.values()),
+        'rejections': rejections,
+        'seconds': time.perf_counter() - started,
+    }
+
+async def publish_batch_job(target_id, config, path, cleaned, work_path):
+    """
+    Publish one cleaned file to one target. Returns the job's summary entry.
+    """
+    result = {
+        'target': target_id,
+        'host': f"{config['host']}:{config['port']}",
+        'path': config['path'],
+        'file': path,
+        'ok': False,
+        'timings': {'clean': round(cleaned['seconds'], 3)},
+    }
+    started = time.perf_counter()
+    lock_token = None
+    publish_diff = None
+    ftp = None
+    try:
+        lock_token = await acquire_publish_lock(config)
+        try:
+            publish_diff = await asyncio.to_thread(
+                compute_publish_diff, config, cleaned['cleaned_path'],
+                config.get('publish_patches', PUBLISH_PATCH_FILES), work_path
+            )
+            result['added'], result['removed'] = publish_diff['added'], publish_diff['removed']
+        except Exception as e:
+            logger.error(f"Error computing publish diff for {target_id}: {e}")
+        result['timings']['lock & diff'] = round(time.perf_counter() - started, 3)
+        
+        stage_started = time.perf_counter()
+        ftp = await asyncio.to_thread(open_ftp_session, config)
+        result['timings']['ftp connect'] = round(time.perf_counter() - stage_started, 3)
+        
+        upload_name = f"{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp"
+        published = await asyncio.to_thread(
+            publish_file, ftp, config, cleaned['cleaned_path'], upload_name, publish_diff
+        )
+        result['streams'] = published['streams']
+        result['old_file_replaced'] = published['old_file_deleted']
+        if published['verification']:
+            result['verification'] = {
+                key: published['verification'][key] for key in ('algorithm', 'size', 'modified', 'attempts')
+            }
+        for stage, seconds in published['timings'].items():
+            result['timings'][stage] = round(seconds, 3)
+        result['ok'] = True
+        
+        try:
+            await asyncio.to_thread(
+                archive_upload, target_id, config, cleaned['cleaned_path'], os.path.basename(path), publish_diff
+            )
+        except Exception as e:
+            logger.error(f"Error archiving {path} for {target_id}: {e}")
+    except Exception as e:
+        logger.error(f"Publishing {path} to {target_id} failed: {e}")
+        result['error'] = str(e)
+    finally:
+        if ftp:
+            await asyncio.to_thread(close_ftp_session, ftp)
+        if lock_token:
+            await asyncio.to_thread(release_publish_lock, config, lock_token)
+        if publish_diff:
+            for diff_path in (publish_diff['snapshot_path'], publish_diff['added_path'], publish_diff['removed_path']):
+                if diff_path and os.path.exists(diff_path):
+                    os.unlink(diff_path)
+    result['timings']['publish total'] = round(time.perf_counter() - started, 3)
+    return result
+
+async def run_batch_publish(file_specs, target_ids, concurrency=BATCH_CONCURRENCY, dry_run=False):
+    """
+    Clean every input file once, then publish to the targets with at most
+    `concurrency` files cleaning / targets publishing at a time.
+    Returns the JSON-serializable summary.
+    """
+    import tempfile
+    
+    jobs = resolve_batch_jobs(file_specs, target_ids)
+    paths = list(dict.fromkeys(path for _, _, path in jobs))
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    work_dir = tempfile.mkdtemp(prefix='publish-')
+    
+    async def clean(index, path):
+        async with semaphore:
+            try:
+                return await clean_batch_file(path, work_dir, index)
+            except Exception as e:
+                logger.error(f"Cleaning {path} failed: {e}")
+                return {'error': str(e)}
+    
+    async def publish(index, target_id, config, path):
+        cleaned = cleaned_files[path]
+        if 'error' in cleaned:
+            return {'target': target_id, 'file': path, 'ok': False, 'error': f"cleaning failed: {cleaned['error']}"}
+        async with semaphore:
+            return await publish_batch_job(
+                target_id, config, path, cleaned, os.path.join(work_dir, f"job{index}")
+            )
+    
+    try:
+        cleaned_files = dict(zip(paths, await asyncio.gather(*(clean(index, path) for index, path in enumerate(paths)))))
+        summary = {
+            'dry_run': dry_run,
+            'concurrency': concurrency,
+            'files': [
+                {'file': path, **{key: value for key, value in cleaned.items() if key != 'cleaned_path'}}
+                for path, cleaned in cleaned_files.items()
+            ],
+        }
+        for entry in summary['files']:
+            if 'seconds' in entry:
+                entry['seconds'] = round(entry['seconds'], 3)
+        
+        if not dry_run:
+            summary['targets'] = list(await asyncio.gather(*(
+                publish(index, target_id, config, path)
+                for index, (target_id, config, path) in enumerate(jobs)
+            )))
+        summary['ok'] = all('error' not in entry for entry in summary['files']) and all(
+            entry['ok'] for entry in summary.get('targets', [])
+        )
+        summary['seconds'] = round(time.perf_counter() - started, 3)
+        return summary
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def batch_publish_main(args):
+    if STATE_BACKEND == 'json' and not args.dry_run and not claim_json_backend():
+        logger.error(
+            "❌ The bot is running with STATE_BACKEND=json, whose publish locks other processes can't see; "
+            "stop it first or use STATE_BACKEND=sqlite or redis"
+        )
+        return 2
+    try:
+        summary = asyncio.run(run_batch_publish(args.files, args.target, args.concurrency, args.dry_run))
+    except ValueError as e:
+        logger.error(f"❌ {e}")
+        return 2
+    print(json.dumps(summary, indent=2))
+    return 0 if summary['ok'] else 1
+
+def encrypt_configs_main():
+    if not CONFIG_MASTER_KEY:
+        logger.error("❌ Set CONFIG_MASTER_KEY to encrypt configs")
+        return 2
+    count = get_state_backend().encrypt_plaintext('config')
+    logger.info(f"🔐 Encrypted {count} config(s)")
+    return 0
+
+STARTUP_PROFILE_TOP_IMPORTS = 15
+IMPORTTIME_LINE_PATTERN = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+def profile_imports():
+    """
+    Import main in a fresh interpreter with -X importtime and return
+    (total_us, [(cumulative_us, module), ...]) for its direct imports,
+    slowest first.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    total = 0
+    entries = []
+    pending = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE_PATTERN.match(line)
+        if not match:
+            continue
+        cumulative, depth, name = int(match.group(2)), len(match.group(3)) // 2, match.group(4)
+        if depth == 1:
+            pending.append((cumulative, name))
+        elif depth == 0:
+            if name == 'main':
+                total, entries = cumulative, pending
+            pending = []
+    entries.sort(reverse=True)
+    return total, entries
+
+def log_startup_profile():
+    logger.info(f"⏱️ main.py imported in {(STARTUP_IMPORTED - STARTUP_STARTED) * 1000:.0f} ms")
+    total, entries = profile_imports()
+    if not entries:
+        logger.warning("⏱️ Could not collect the import-time breakdown")
+        return
+    logger.info(f"⏱️ Import breakdown (fresh interpreter, {total / 1000:.0f} ms total):")
+    for cumulative, name in entries[:STARTUP_PROFILE_TOP_IMPORTS]:
+        logger.info(f"⏱️   {cumulative / 1000:8.1f} ms  {name}")
+
+def add_startup_profiling(application, phases):
+    """
+    Log how long each startup phase took once the first update arrives,
+    followed by the import breakdown (collected then so it doesn't skew the
+    timings).
+    """
+    async def post_init(application):
+        phases.append(('initialize (getMe)', time.perf_counter()))
+    
+    async def first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if phases[-1][0] == 'first update':
+            return
+        phases.append(('first update', time.perf_counter()))
+        previous = STARTUP_STARTED
+        for name, at in phases:
+            logger.info(f"⏱️ {name}: +{(at - previous) * 1000:.0f} ms")
+            previous = at
+        logger.info(f"⏱️ Time to first update: {(previous - STARTUP_STARTED) * 1000:.0f} ms")
+        await asyncio.to_thread(log_startup_profile)
+    
+    application.post_init = post_init
+    application.add_handler(TypeHandler(Update, first_update, block=False), group=-1)
+
 def main():
+    parser = argparse.ArgumentParser(description="FTP Pullzone Telegram bot")
+    parser.add_argument('--role', choices=['single', 'poller', 'worker'], default='single',
+                        help="single: poll and handle updates (default); poller/worker: multi-worker mode")
+    parser.add_argument('--worker-index', type=int, default=0, help="index of this worker (0 to BOT_WORKERS - 1)")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="log import times and time to the first handled update")
+    subparsers = parser.add_subparsers(dest='command')
+    publish_parser = subparsers.add_parser('publish', help="clean and publish files without Telegram")
+    publish_parser.add_argument('files', nargs='+', metavar='FILE',
+                                help="list to publish to every selected target, or TARGET=FILE for one target")
+    publish_parser.add_argument('--target', action='append', default=[],
+                                help="target (user id in the FTP config store); repeatable, default: all")
+    publish_parser.add_argument('--concurrency', type=positive_int, default=BATCH_CONCURRENCY,
+                                help=f"files cleaned / targets published at once (default {BATCH_CONCURRENCY})")
+    publish_parser.add_argument('--dry-run', action='store_true', help="only clean and report timings")
+    subparsers.add_parser('encrypt-configs', help="encrypt configs still stored in plain text (needs CONFIG_MASTER_KEY)")
+    args = parser.parse_args()
+    
+    if args.command == 'publish':
+        sys.exit(batch_publish_main(args))
+    
+    if args.command == 'encrypt-configs':
+        sys.exit(encrypt_configs_main())
+    
     TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
     
     if not TOKEN:
@@ -977,64 +3351,62 @@ def main():
         logger.error("Please set the token in Replit Secrets")
         return
     
-    try:
-        flask_thread = Thread(target=run_flask, daemon=True)
-        flask_thread.start()
-        logger.info("✅ Flask keep-alive server started on port 8080")
-    except Exception as e:
-        logger.error(f"⚠️ Flask server failed to start: {e}")
+    if args.role != 'single' and STATE_BACKEND == 'json':
+        logger.error("❌ Multi-worker mode needs STATE_BACKEND=sqlite or STATE_BACKEND=redis")
+        return
+    
+    if CONFIG_MASTER_KEY and args.role != 'poller':
+        # Derive the key and decrypt the saved configs now (which also
+        # checks the key) instead of on the first button press.
+        try:
+            configs = get_state_backend().items('config')
+            logger.info(f"🔐 Loaded {len(configs)} encrypted config(s)")
+        except Exception as e:
+            logger.error(f"❌ Could not load encrypted configs: {e}")
+            return
+    
+    if args.role != 'worker':
+        try:
+            flask_thread = Thread(target=run_flask, daemon=True)
+            flask_thread.start()
+            logger.info("✅ Flask keep-alive server started on port 8080")
+        except Exception as e:
+            logger.error(f"⚠️ Flask server failed to start: {e}")
     
     try:
-        application = Application.builder().token(TOKEN).build()
+        if args.role == 'poller':
+            asyncio.run(run_update_poller(TOKEN, BOT_WORKERS))
+            return
         
-        setup_handler = ConversationHandler(
-            entry_points=[
-                CommandHandler('setup', lambda u, c: setup_start(u, c, is_callback=False)),
-                CallbackQueryHandler(button_handler, pattern="^menu_setup$")
-            ],
-            states={
-                FTP_HOST: [MessageHandler(filters.TEXT & ~filters.COMMAND, ftp_host)],
-                FTP_PORT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ftp_port)],
-                FTP_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, ftp_user)],
-                FTP_PASS: [MessageHandler(filters.TEXT & ~filters.COMMAND, ftp_pass)],
-                FTP_PATH: [MessageHandler(filters.TEXT & ~filters.COMMAND, ftp_path)],
-            },
-            fallbacks=[
-                CommandHandler('cancel', setup_cancel),
-                CallbackQueryHandler(button_handler, pattern="^cancel_setup$")
-            ],
-            allow_reentry=True
-        )
+        if args.role == 'worker':
+            if not 0 <= args.worker_index < BOT_WORKERS:
+                logger.error(f"❌ --worker-index must be between 0 and {BOT_WORKERS - 1}")
+                return
+            asyncio.run(run_update_worker(TOKEN, args.worker_index))
+            return
         
-        upload_handler = ConversationHandler(
-            entry_points=[
-                CommandHandler('upload', lambda u, c: upload_start(u, c, is_callback=False)),
-                CallbackQueryHandler(button_handler, pattern="^menu_upload$")
-            ],
-            states={
-                UPLOAD_FILE: [MessageHandler(filters.Document.ALL, upload_file)],
-            },
-            fallbacks=[CommandHandler('cancel', upload_cancel)],
-            allow_reentry=True
-        )
+        if STATE_BACKEND == 'json' and not claim_json_backend():
+            logger.info("⏳ Waiting for a batch publish (python main.py publish) to finish...")
+            claim_json_backend(blocking=True)
         
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", lambda u, c: show_help(u, is_callback=False)))
-        application.add_handler(CommandHandler("status", lambda u, c: test_connection(u, u.effective_user.id, is_callback=False)))
-        application.add_handler(setup_handler)
-        application.add_handler(upload_handler)
-        application.add_handler(CallbackQueryHandler(button_handler))
+        phases = [('import main', STARTUP_IMPORTED)]
+        application = build_application(TOKEN)
+        phases.append(('build application', time.perf_counter()))
+        if args.profile_startup:
+            add_startup_profiling(application, phases)
         
         logger.info("🤖 Bot started successfully!")
         logger.info("📡 Listening for updates...")
         
         application.run_polling(
             allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
+            drop_pending_updates=DROP_PENDING_UPDATES
         )
     
     except Exception as e:
         logger.error(f"❌ Fatal error: {e}\n{traceback.format_exc()}")
 
+STARTUP_IMPORTED = time.perf_counter()
+
 if __name__ == '__main__':
     main()